@@ -0,0 +1,34 @@
+"""
+Benchmark of registry serialization, comparing a cold snapshot (every object serialized) to a warm snapshot
+(cached fragments concatenated). Run with: python benchmarks/serialization.py [number of tools] [number of data]
+"""
+import sys
+import json
+from timeit import timeit
+from nbtools.tool_manager import NBTool, Data
+
+
+def cold(objects):
+    for o in objects: o.invalidate()
+    return json.dumps([o.json_safe() for o in objects])
+
+
+def warm(objects):
+    return '[' + ','.join(o.json_fragment() for o in objects) + ']'
+
+
+if __name__ == '__main__':
+    tool_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    data_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+
+    objects = [NBTool(origin='GenePattern', id=f'urn:lsid:{i}', name=f'Module{i}', description='A module ' * 20,
+                      tags=['analysis', 'genomics'], version='1') for i in range(tool_count)] + \
+              [Data(origin='GenePattern', group=f'Job {i // 10}', uri=f'https://example.org/jobs/{i}/out.gct',
+                    label='out.gct', kind='gct') for i in range(data_count)]
+    warm(objects)  # Populate the cache
+
+    runs = 5
+    cold_time = timeit(lambda: cold(objects), number=runs) / runs
+    warm_time = timeit(lambda: warm(objects), number=runs) / runs
+    print(f'{tool_count} tools, {data_count} data: cold {cold_time * 1000:.1f} ms, warm {warm_time * 1000:.1f} ms, '
+          f'speedup {cold_time / warm_time:.1f}x')
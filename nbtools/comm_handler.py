@@ -0,0 +1,76 @@
+import asyncio
+from collections import deque
+from threading import Lock
+
+
+class CommHandler(object):
+    """
+    Function which handles a type of comm message, along with how it is run
+
+    Handlers run in one of three modes: 'inline' on the comm message handler, 'thread' on a thread pool, or
+    'async' as a coroutine on the kernel's event loop. In the thread and async modes at most max_concurrency calls
+    run at once, further calls wait and run in the order they were received.
+    """
+    MODES = ('inline', 'thread', 'async')
+
+    def __init__(self, function, mode='inline', max_concurrency=None):
+        if mode not in CommHandler.MODES: raise ValueError(f'CommHandler mode must be one of {CommHandler.MODES}')
+        self.function = function                # The function to call, a coroutine function in async mode
+        self.mode = mode                        # How the function is run
+        self.max_concurrency = max_concurrency  # Maximum number of concurrent calls, None if unlimited
+        self.running = 0                        # Number of calls currently running
+        self.waiting = deque()                  # Arguments of calls waiting to run
+        self.lock = Lock()                      # Guards running and waiting
+
+    def __call__(self, *args):
+        """Call the function directly, in the caller's thread"""
+        return self.function(*args)
+
+    def dispatch(self, args, on_error, executor):
+        """
+        Run the function with the provided arguments according to the handler's mode
+
+        :param args: tuple of arguments to pass to the function
+        :param on_error: callback passed any exception raised by the function
+        :param executor: thread pool used by the thread mode, and by the async mode if no event loop is running
+        """
+        if self.mode == 'inline':
+            try: self.function(*args)
+            except Exception as e: on_error(e)
+            return
+
+        # Wait if the concurrency limit has been reached
+        with self.lock:
+            if self.max_concurrency and self.running >= self.max_concurrency:
+                self.waiting.append(args)
+                return
+            self.running += 1
+        self._start(args, on_error, executor)
+
+    def _start(self, args, on_error, executor):
+        """Start a call on the thread pool or event loop"""
+        try:
+            if self.mode == 'thread': future = executor.submit(self.function, *args)
+            else:
+                coroutine = self.function(*args)
+                try: future = asyncio.get_running_loop().create_task(coroutine)
+                except RuntimeError: future = executor.submit(asyncio.run, coroutine)  # No loop in this thread
+        except Exception as e:  # The call couldn't be started
+            on_error(e)
+            self._next(on_error, executor)
+            return
+        future.add_done_callback(lambda f: self._finished(f, on_error, executor))
+
+    def _finished(self, future, on_error, executor):
+        """Report any error raised by a finished call and start the next waiting call"""
+        if not future.cancelled() and future.exception() is not None: on_error(future.exception())
+        self._next(on_error, executor)
+
+    def _next(self, on_error, executor):
+        """Start the next waiting call, if any"""
+        with self.lock:
+            if not self.waiting:
+                self.running -= 1
+                return
+            args = self.waiting.popleft()
+        self._start(args, on_error, executor)
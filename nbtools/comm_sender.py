@@ -0,0 +1,86 @@
+import json
+import logging
+from collections import deque
+from threading import Condition, Thread
+from time import perf_counter
+
+
+class CommSender(object):
+    """
+    Sends messages to client comms from a single long-lived worker thread
+
+    Messages are sent in the order they are queued. A message queued with coalesce=True replaces any pending
+    message of the same type for the same comm, so that a burst of updates results in a single send. When the
+    queue is full, callers block until the worker catches up.
+    """
+    MAX_QUEUE = 1000  # Maximum number of pending messages before callers block
+
+    def __init__(self, max_queue=MAX_QUEUE, stats=None):
+        self.max_queue = max_queue      # Maximum number of pending messages
+        self.stats = stats              # Optional CommStats recording the size and send time of each message
+        self.queue = deque()            # Pending (comm, message, buffers, coalesce, size) tuples, oldest first
+        self.condition = Condition()    # Guards the queue and signals the worker
+        self.in_flight = 0              # Number of messages taken from the queue but not yet sent
+        self.coalesced = 0              # Number of messages replaced by a newer message before being sent
+        self.worker = None              # The sender thread, lazily started
+
+    @property
+    def depth(self):
+        """The number of messages waiting to be sent"""
+        return len(self.queue)
+
+    def send(self, comm, message, buffers=None, coalesce=False, size=None):
+        """
+        Queue a message, and optionally a list of binary buffers, to be sent to the comm. Pass the encoded size of
+        large messages if known, otherwise it's measured for the stats by serializing the message again.
+        """
+        with self.condition:
+            # Remove any pending message this one supersedes
+            if coalesce:
+                superseded = [m for m in self.queue if m[0] is comm and m[3] and m[1]['func'] == message['func']]
+                for m in superseded: self.queue.remove(m)
+                self.coalesced += len(superseded)
+
+            # Apply backpressure if the worker has fallen behind
+            while len(self.queue) >= self.max_queue: self.condition.wait()
+
+            self.queue.append((comm, message, buffers, coalesce, size))
+            self._ensure_worker()
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until all queued messages have been sent, return False if the timeout elapsed first"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and not self.in_flight, timeout)
+
+    @staticmethod
+    def _size(message, buffers):
+        """Return the size of the message in bytes, as encoded for the comm"""
+        size = len(json.dumps(message, default=str).encode('utf-8'))
+        return size + sum(len(b) for b in buffers) if buffers else size
+
+    def _ensure_worker(self):
+        """Lazily start the worker thread"""
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = Thread(target=self._run, name='nbtools-comm-sender', daemon=True)
+            self.worker.start()
+
+    def _run(self):
+        """Send queued messages in order, for as long as the kernel runs"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                comm, message, buffers, _, size = self.queue.popleft()
+                self.in_flight += 1
+                self.condition.notify_all()
+
+            started = perf_counter()
+            try: comm.send(message, buffers=buffers)
+            except Exception as e: logging.warning(f'nbtools unable to send {message["func"]} message: {e}')
+            if self.stats:
+                if size is None: size = self._size(message, buffers)
+                self.stats.record_sent(message['func'], size, perf_counter() - started)
+
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
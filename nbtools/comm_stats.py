@@ -0,0 +1,69 @@
+import heapq
+from threading import Lock
+from time import time
+
+
+class CommStats(object):
+    """
+    Counters describing the traffic between the kernel and its clients: update serialization, messages sent and
+    received by func, and the largest payloads sent. Counters are updated from both the kernel and sender threads.
+    """
+    LARGEST = 10  # Number of largest payloads to keep
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Reset all counters to zero"""
+        with self.lock:
+            self.started = time()           # When counting began
+            self.updates = 0                # Number of calls to send_update()
+            self.serialization_time = 0.0   # Seconds spent building and encoding update payloads
+            self.queued_updates = 0         # Number of updates postponed by queue_update()
+            self.sent = {}                  # func -> {'count', 'bytes', 'time'} of messages sent to clients
+            self.received = {}              # func -> number of messages received from clients
+            self.largest = []               # Min-heap of (bytes, func, timestamp) of the largest payloads sent
+
+    def record_update(self, duration):
+        """Record a send_update() call and the time spent serializing it"""
+        with self.lock:
+            self.updates += 1
+            self.serialization_time += duration
+
+    def record_queued_update(self):
+        """Record an update postponed by queue_update()"""
+        with self.lock: self.queued_updates += 1
+
+    def record_received(self, func):
+        """Record a message received from a client"""
+        with self.lock: self.received[func] = self.received.get(func, 0) + 1
+
+    def record_sent(self, func, size, duration):
+        """Record a message sent to a client, its size in bytes and the time taken to send it"""
+        with self.lock:
+            counts = self.sent.setdefault(func, {'count': 0, 'bytes': 0, 'time': 0.0})
+            counts['count'] += 1
+            counts['bytes'] += size
+            counts['time'] += duration
+
+            # Keep the largest payloads
+            entry = (size, func, time())
+            if len(self.largest) < CommStats.LARGEST: heapq.heappush(self.largest, entry)
+            elif size > self.largest[0][0]: heapq.heapreplace(self.largest, entry)
+
+    def snapshot(self):
+        """Return a JSON-safe dict of the current counters"""
+        with self.lock:
+            return {
+                'since': self.started,
+                'updates': {
+                    'count': self.updates,
+                    'queued': self.queued_updates,
+                    'serialization_time': self.serialization_time,
+                },
+                'sent': {func: dict(counts) for func, counts in self.sent.items()},
+                'received': dict(self.received),
+                'largest': [{'bytes': size, 'func': func, 'time': timestamp}
+                            for size, func, timestamp in sorted(self.largest, reverse=True)],
+            }
@@ -0,0 +1,78 @@
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+from .event_manager import EventManager
+
+
+class DataProbe(object):
+    """
+    Reads the size, modification time and optionally a checksum of local files registered as data, on a thread pool
+    so that registration isn't blocked. Results are set as the size, modified and checksum attributes of the Data
+    object, and announced with an nbtools.data_probe event. Checksums are cached by (path, mtime, size), so
+    unchanged files are only hashed once.
+    """
+    CHUNK_SIZE = 1024 * 1024                            # Bytes read at a time when hashing
+    SCHEME = re.compile('^[A-Za-z][A-Za-z0-9+.-]*://')  # Pattern of a URL scheme
+
+    def __init__(self, algorithm=None, workers=2):
+        if algorithm is not None: hashlib.new(algorithm)  # Raise ValueError early if the algorithm is unknown
+        self.algorithm = algorithm  # Name of the hashlib algorithm used for checksums, None to skip hashing
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nbtools-probe')
+        self.checksums = {}         # (path, mtime, size) -> checksum
+        self.lock = Lock()          # Guards the checksum cache
+
+    @staticmethod
+    def local_path(uri):
+        """Return the local file path of a uri, or None if it isn't a local path or file:// URL"""
+        if not isinstance(uri, str) or not uri: return None
+        if uri.startswith('file://'): return url2pathname(urlparse(uri).path)
+        if DataProbe.SCHEME.match(uri): return None
+        return uri
+
+    def submit(self, data):
+        """Probe the data's file in the background, return the future or None if the data isn't a local file"""
+        path = DataProbe.local_path(data.uri)
+        if path is None: return None
+        return self.executor.submit(self._probe, data, path)
+
+    def shutdown(self):
+        """Stop probing once the pending probes finish"""
+        self.executor.shutdown(wait=False)
+
+    def _probe(self, data, path):
+        """Read the file's metadata and set it on the data"""
+        try:
+            stat = os.stat(path)
+            checksum = self._checksum(path, stat.st_mtime, stat.st_size) if self.algorithm else None
+        except OSError as e:
+            logging.debug(f'nbtools unable to probe {path}: {e}')
+            return
+
+        data.size = stat.st_size
+        data.modified = stat.st_mtime
+        data.checksum = checksum
+        EventManager.instance().dispatch('nbtools.data_probe', {
+            'origin': data.origin,
+            'uri': data.uri,
+            'size': data.size,
+            'modified': data.modified,
+            'checksum': data.checksum
+        })
+
+    def _checksum(self, path, mtime, size):
+        """Return the checksum of the file, hashing it in chunks unless it's cached for this mtime and size"""
+        key = (path, mtime, size)
+        with self.lock:
+            if key in self.checksums: return self.checksums[key]
+
+        digest = hashlib.new(self.algorithm)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DataProbe.CHUNK_SIZE), b''): digest.update(chunk)
+
+        with self.lock: self.checksums[key] = digest.hexdigest()
+        return self.checksums[key]
@@ -1,4 +1,50 @@
+import asyncio
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from inspect import ismethod
+from threading import RLock, Timer
+
+
+class Subscription(object):
+    """
+    Handle to a callback registered with the EventManager, call unsubscribe() to stop receiving the event
+    """
+
+    def __init__(self, manager, event, callback, once=False, weak=False, key=None):
+        self.manager = manager                   # The EventManager the callback is registered with
+        self.event = event                       # The name of the event
+        self.key = key                           # Only dispatches of the event with this key are received, if set
+        self.once = once                         # Unsubscribe after the first dispatch?
+        self.active = True                       # Is the callback still subscribed?
+
+        # Hold the callback weakly if requested, unsubscribing once it is garbage collected
+        if not weak: self.reference = lambda: callback
+        elif ismethod(callback): self.reference = weakref.WeakMethod(callback, self._expired)
+        else: self.reference = weakref.ref(callback, self._expired)
+
+    @property
+    def callback(self):
+        """The subscribed callback, or None if unsubscribed or garbage collected"""
+        return self.reference() if self.active else None
+
+    def unsubscribe(self):
+        """Stop calling the callback when the event is dispatched"""
+        self.manager.unregister(self.event, self)
+
+    def _expired(self, reference):
+        self.unsubscribe()
+
+
 class EventManager(object):
+    """
+    Dispatches named events to the callbacks registered for them
+
+    By default callbacks run in the dispatching thread, in the order they were registered. configure() can instead
+    schedule them on the kernel's asyncio loop or a worker pool, and coalesce repeated keyed events. An exception
+    raised by one callback is logged and doesn't stop the others.
+    """
+    MODES = ('inline', 'thread', 'async')        # Ways callbacks can be run
     _instance = None                             # EventManager singleton
 
     @staticmethod
@@ -8,17 +54,131 @@ class EventManager(object):
         return EventManager._instance
 
     def __init__(self):
-        self.events = {}                         # A map of event names -> list of registered callbacks
+        self.events = {}                         # A map of event names -> list of subscriptions
+        self.keyed = {}                          # A map of event names -> key -> list of keyed subscriptions
+        self.lock = RLock()                      # Guards the subscription lists and pending events
+        self.mode = 'inline'                     # How callbacks are run
+        self.coalesce = None                     # Seconds to wait for repeats of a keyed event, None to not wait
+        self.pending = {}                        # (event, key, keyed only) -> latest data of coalesced events
+        self.loop = None                         # The kernel's event loop, in async mode
+        self.executor = None                     # Worker pool running callbacks, lazily created
+        self.workers = 1                         # Size of the worker pool
+
+    def configure(self, mode='inline', workers=1, coalesce=None):
+        """
+        Configure how callbacks are run
+
+        :param mode: 'inline' to run callbacks in the dispatching thread, 'thread' to run them on a worker pool, or
+                     'async' to schedule them on the kernel's event loop (call from the kernel thread), falling back to
+                     the worker pool if no loop is running
+        :param workers: size of the worker pool, with a single worker events are delivered in the order dispatched
+        :param coalesce: seconds to wait before delivering an event dispatched with a key. Repeats of the event with
+                         the same key during the wait are merged, and callbacks only receive the latest data.
+        """
+        if mode not in EventManager.MODES: raise ValueError(f'EventManager mode must be one of {EventManager.MODES}')
+        if self.executor: self.executor.shutdown(wait=False)
+        self.mode = mode
+        self.workers = workers
+        self.coalesce = coalesce
+        self.executor = None
+        try: self.loop = asyncio.get_running_loop() if mode == 'async' else None
+        except RuntimeError: self.loop = None
+
+    def register(self, event, callback, once=False, weak=False, key=None):
+        """
+        Register an event callback with the event manager
+
+        :param event: name of the event
+        :param callback: function called with the event data as the data keyword argument
+        :param once: unsubscribe the callback after it is first called
+        :param weak: hold the callback with a weak reference, unsubscribing it once it is garbage collected
+        :param key: only call the callback when the event is dispatched with this key, such as (origin, id)
+        :return: Subscription, call its unsubscribe() method to remove the callback
+        """
+        subscription = Subscription(self, event, callback, once=once, weak=weak, key=key)
+        with self.lock:
+            # Lazily create empty list of callbacks
+            lists = self.events if key is None else self.keyed.setdefault(event, {})
+            name = event if key is None else key
+            if name not in lists: lists[name] = []
+
+            lists[name].append(subscription)     # Add callback to the list
+        return subscription
+
+    def unregister(self, event, callback, key=None):
+        """Remove a callback, or the Subscription returned when it was registered, return True if it was found"""
+        if isinstance(callback, Subscription): key = callback.key
+        with self.lock:
+            lists = self.events if key is None else self.keyed.get(event, {})
+            name = event if key is None else key
+            subscriptions = lists.get(name, [])
+            for subscription in subscriptions:
+                if subscription is callback or (subscription.active and subscription.callback == callback):
+                    subscription.active = False
+                    subscriptions.remove(subscription)
+                    if not subscriptions: del lists[name]
+                    if key is not None and not lists: del self.keyed[event]
+                    return True
+        return False
+
+    def subscribers(self, event, key=None):
+        """Return the number of callbacks called when the event is dispatched, with the key if provided"""
+        with self.lock: return len(self._subscriptions(event, key))
+
+    def _subscriptions(self, event, key, keyed_only=False):
+        """Return a copy of the subscriptions to an event dispatched with the key, callbacks may unsubscribe"""
+        with self.lock:
+            subscriptions = [] if keyed_only else list(self.events.get(event, []))
+            if key is not None: subscriptions += self.keyed.get(event, {}).get(key, [])
+            return subscriptions
+
+    def route(self, event, data, key):
+        """Dispatch an event only to the callbacks subscribed to it with the key"""
+        self._send(event, data, key, keyed_only=True)
+
+    def dispatch(self, event, data=None, key=None):
+        """
+        Dispatch an event to trigger registered callbacks. Callbacks registered with a key are only called if the
+        event is dispatched with the same key, and are found with a dict lookup rather than filtering each callback.
+        """
+        self._send(event, data, key, keyed_only=False)
+
+    def _send(self, event, data, key, keyed_only):
+        """Deliver the event according to the configured mode, merging repeats of keyed events if coalescing"""
+        if self.coalesce and key is not None:
+            with self.lock:
+                queued = (event, key, keyed_only) in self.pending
+                self.pending[(event, key, keyed_only)] = data
+            if not queued: self._schedule(lambda: self._flush(event, key, keyed_only), self.coalesce)
+        else:
+            subscriptions = self._subscriptions(event, key, keyed_only)
+            if subscriptions: self._schedule(lambda: self._call(event, subscriptions, data))
 
-    def register(self, event, callback):
-        """Register an event callback with the event manager"""
-        # Lazily create empty list of callbacks
-        if event not in self.events:  self.events[event] = []
+    def _flush(self, event, key, keyed_only):
+        """Deliver the latest data of a coalesced event"""
+        with self.lock: data = self.pending.pop((event, key, keyed_only))
+        self._call(event, self._subscriptions(event, key, keyed_only), data)
 
-        self.events[event].append(callback)      # Add callback to the list
+    def _schedule(self, job, delay=0):
+        """Run the job, after the delay in seconds, in the dispatching thread, on the event loop or on the pool"""
+        if self.mode == 'async' and self.loop is not None and self.loop.is_running():
+            if delay: self.loop.call_soon_threadsafe(self.loop.call_later, delay, job)
+            else: self.loop.call_soon_threadsafe(job)
+        elif delay:
+            timer = Timer(delay, self._schedule, (job,))
+            timer.daemon = True
+            timer.start()
+        elif self.mode == 'inline': job()
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='nbtools-events')
+            self.executor.submit(job)
 
-    def dispatch(self, event, data=None):
-        """Dispatch an event to trigger registered callbacks"""
-        if event in self.events:                 # If callbacks are registered for this event
-            for callback in self.events[event]:  # Loop over each registered callback
-                callback(data=data)              # Run the callback, passing in the provided data
+    def _call(self, event, subscriptions, data):
+        """Call each subscribed callback with the event data, logging any errors"""
+        for subscription in subscriptions:       # Loop over each registered callback
+            callback = subscription.callback
+            if callback is None: continue        # Unsubscribed by an earlier callback, or garbage collected
+            if subscription.once: subscription.unsubscribe()
+            try: callback(data=data)             # Run the callback, passing in the provided data
+            except Exception: logging.exception(f'nbtools callback for the {event} event raised an error')
@@ -1,4 +1,6 @@
 import os
+import traceback
+from concurrent.futures import Future
 from numbers import Integral, Real
 from IPython import get_ipython
 from ipython_genutils.py3compat import string_types, unicode_type
@@ -7,6 +9,7 @@ from ipywidgets import interactive, Text, GridBox, Label, Layout, ValueWidget, F
 from ipyuploads import Upload
 from traitlets import List, Dict, All
 from .parsing_manager import ParsingManager
+from .tool_executor import ToolExecutor
 from .utils import usage_tracker
 
 
@@ -494,6 +497,10 @@ class InteractiveForm(interactive):
         # Increment the usage counter
         usage_tracker('tool_run', description=f'{self.parent.origin}|{self.parent.id}|{self.parent.name}')
 
+        # Run the function in the background, if requested
+        execution = getattr(self.parent, 'execution', 'inline') if self.parent else 'inline'
+        if execution != 'inline': return self.run_in_background(execution)
+
         # Call the function
         super(InteractiveForm, self).update(*args)
 
@@ -502,3 +509,29 @@ class InteractiveForm(interactive):
 
         # Assign value to output_var
         if len(self.children) >= 1: get_ipython().push({self.children[-1].value: self.result})
+
+    def run_in_background(self, execution):
+        """Read the form and submit the call to the ToolExecutor, return the future of its result"""
+        output_var = self.children[-1].value if len(self.children) >= 1 else None
+        if self.manual: self.manual_button.disabled = True  # Until the call completes, so calls don't overlap
+        if self.clear_output: self.out.clear_output(wait=True)
+        try:
+            # Values are read and parsed in the kernel thread, before the call is submitted
+            with self.out: self.kwargs = {widget._kwarg: widget.get_interact_value() for widget in self.kwargs_widgets}
+            self.future = ToolExecutor.instance().submit(self.f, self.kwargs, self.out, mode=execution)
+        except Exception as e:
+            self.future = Future()
+            self.future.set_exception(e)
+        self.future.add_done_callback(lambda future: self._background_done(future, output_var))
+        return self.future
+
+    def _background_done(self, future, output_var):
+        """Show any error, assign the result to output_var and re-enable the form once a background call completes"""
+        try:
+            self.result = future.result()
+            if output_var: get_ipython().push({output_var: self.result})
+        except Exception as e:
+            self.out.append_stderr(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+        finally:
+            if self.manual: self.manual_button.disabled = False
+            if self.parent: self.parent.busy = False
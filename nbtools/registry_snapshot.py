@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+from threading import Lock
+
+
+class RegistrySnapshot(object):
+    """
+    SQLite file holding the serialized tools, origins and data registered in a kernel, so that after a restart the
+    client can be shown the previous registries while the real registrations are still arriving
+
+    Each row holds the JSON form of one registry entry, identified by its section and key. Changes are written
+    incrementally: only the entries added, changed or removed since the last write are touched.
+    """
+
+    def __init__(self, path):
+        self.path = path    # Path to the SQLite file
+        self.lock = Lock()  # Serializes writes from the kernel and timer threads
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries (section TEXT, key TEXT, value TEXT, '
+                       'PRIMARY KEY (section, key))')
+
+    @contextmanager
+    def _connect(self):
+        """Open a connection for one transaction, a connection per operation lets the file be used from any thread"""
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db: yield db  # Commit, or roll back on error
+        finally: db.close()
+
+    def load(self):
+        """Return a dict of section -> list of (key, JSON-safe dict) read from the file"""
+        entries = {}
+        try:
+            with self._connect() as db:
+                for section, key, value in db.execute('SELECT section, key, value FROM entries ORDER BY rowid'):
+                    key = json.loads(key)
+                    entries.setdefault(section, []).append((tuple(key) if isinstance(key, list) else key,
+                                                            json.loads(value)))
+        except (sqlite3.Error, ValueError) as e: logging.warning(f'nbtools unable to load registry snapshot: {e}')
+        return entries
+
+    def write(self, changes, replace=False):
+        """
+        Write changed entries to the file
+
+        :param changes: list of (section, key, JSON fragment) tuples, with a fragment of None for removed entries
+        :param replace: discard all existing entries first
+        """
+        try:
+            with self.lock, self._connect() as db:
+                if replace: db.execute('DELETE FROM entries')
+                db.executemany('DELETE FROM entries WHERE section = ? AND key = ?',
+                               [(section, json.dumps(key)) for section, key, fragment in changes if fragment is None])
+                db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                               [(section, json.dumps(key), fragment) for section, key, fragment in changes
+                                if fragment is not None])
+        except sqlite3.Error as e: logging.warning(f'nbtools unable to write registry snapshot: {e}')
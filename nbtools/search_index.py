@@ -0,0 +1,79 @@
+import re
+from bisect import bisect_left, insort
+
+
+class SearchIndex(object):
+    """
+    Inverted index over tool metadata, supporting ranked prefix search
+
+    Each indexed document is identified by a key and described by a dict of fields. Every query term must match
+    the start of a token in the document. Matches are ranked by the weight of the field the token appears in,
+    with exact token matches counting double.
+    """
+    WEIGHTS = {'name': 4, 'tags': 3, 'origin': 2, 'description': 1}  # Weight of a match in each field
+    WORD = re.compile('[A-Za-z0-9]+')                                 # Pattern of a word in the text
+    CAMEL_CASE = re.compile('[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')    # Pattern of the parts of a camel case word
+
+    def __init__(self):
+        self.postings = {}      # token -> {key: score}
+        self.tokens = []        # Sorted list of indexed tokens, used for prefix lookups
+        self.documents = {}     # key -> set of tokens, used for removal
+
+    @staticmethod
+    def tokenize(text):
+        """Split text into lowercase alphanumeric tokens, camel case words also yield a token for each part"""
+        tokens = []
+        for word in SearchIndex.WORD.findall(str(text)) if text else []:
+            tokens.append(word.lower())
+            parts = SearchIndex.CAMEL_CASE.findall(word)
+            if len(parts) > 1: tokens += [p.lower() for p in parts]
+        return tokens
+
+    def add(self, key, fields):
+        """Index a document, replacing any document already indexed under the key"""
+        self.remove(key)
+
+        # Score each token by the highest weighted field it appears in
+        scores = {}
+        for field, value in fields.items():
+            weight = SearchIndex.WEIGHTS.get(field, 1)
+            for v in (value if isinstance(value, (list, tuple, set)) else [value]):
+                for token in SearchIndex.tokenize(v): scores[token] = max(scores.get(token, 0), weight)
+
+        # Add the document to the postings of each token
+        for token, score in scores.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                insort(self.tokens, token)
+            self.postings[token][key] = score
+        self.documents[key] = set(scores)
+
+    def remove(self, key):
+        """Remove the document indexed under the key, if any"""
+        for token in self.documents.pop(key, ()):
+            postings = self.postings[token]
+            del postings[key]
+            if not postings:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def search(self, query, limit=None):
+        """Return the keys of documents matching every term in the query, best matches first"""
+        results = None
+        for term in SearchIndex.tokenize(query):
+            # Gather documents with a token starting with the term
+            matches = {}
+            i = bisect_left(self.tokens, term)
+            while i < len(self.tokens) and self.tokens[i].startswith(term):
+                bonus = 2 if self.tokens[i] == term else 1
+                for key, score in self.postings[self.tokens[i]].items():
+                    matches[key] = max(matches.get(key, 0), score * bonus)
+                i += 1
+
+            # Keep only documents which matched every previous term
+            results = matches if results is None else {k: results[k] + s for k, s in matches.items() if k in results}
+            if not results: return []
+
+        if results is None: return []  # Empty query
+        ranked = sorted(results.items(), key=lambda r: -r[1])
+        return [key for key, _ in ranked[:limit]]
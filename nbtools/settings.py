@@ -9,6 +9,7 @@ from .tool_manager import ToolManager
 def load_settings():
     """Attempt to load the nbtools settings files, fall back to default if not available"""
     load = []
+    snapshot = None
     for p in jupyter_core.paths.jupyter_path():                                         # Get Jupyter data paths
         nbtools_path = os.path.join(p, 'nbtools')
         if os.path.exists(nbtools_path) and os.path.isdir(nbtools_path):                # Check for nbtools config
@@ -19,20 +20,27 @@ def load_settings():
                         data = json.load(json_file)
                         if 'load' in data and type(data['load']) is list:               # Ensure correct json format
                             load += data['load']                                        # Add packages to load list
+                        if 'snapshot' in data: snapshot = data['snapshot']              # Registry snapshot setting
                 except FileNotFoundError as e:
                     logging.debug(f'nbtools setting file not found: {e}')
                 except json.JSONDecodeError as e:
                     logging.debug(f'unable to parse nbtools setting file: {e}')
 
     # If packages were read, return the list to load
-    if len(load): return {"load": list(set(load))}
+    if len(load): settings = {"load": list(set(load))}
     # If it couldn't be loaded, return the default settings
-    else: return {"load": ["nbtools"]}
+    else: settings = {"load": ["nbtools"]}
+
+    # Enable the registry snapshot if set to true or to the path of the snapshot file
+    if snapshot: settings['snapshot'] = snapshot
+    return settings
 
 
 def import_defaults():
     ToolManager.instance()  # Lazily initialize, if not already done
     settings = load_settings()
+    if 'snapshot' in settings:  # Restore the registries saved by the last kernel while the packages load
+        ToolManager.enable_snapshot(None if settings['snapshot'] is True else settings['snapshot'])
     for module in settings['load']:
         if module == 'nbtools':  # Special case so that nbtools import detection works
             get_ipython().run_cell(f'import nbtools as _nbtools')
@@ -36,6 +36,19 @@ _widget_attrs = {}
 undefined = object()
 
 
+class MockShell:
+    """A mock IPython shell, providing the kernel comm manager and user namespace used by the ToolManager"""
+
+    def __init__(self):
+        self.user_global_ns = {}
+        self.targets = {}
+        self.kernel = self
+        self.comm_manager = self
+
+    def register_target(self, name, callback):
+        self.targets[name] = callback
+
+
 @pytest.fixture
 def mock_comm():
     _widget_attrs['_comm_default'] = getattr(Widget, '_comm_default', undefined)
@@ -52,3 +65,20 @@ def mock_comm():
             delattr(Widget, attr)
         else:
             setattr(Widget, attr, value)
+
+
+@pytest.fixture
+def tool_manager(monkeypatch):
+    from .. import tool_manager as tool_manager_module
+    from ..event_manager import EventManager
+
+    monkeypatch.setattr(tool_manager_module, 'get_ipython', lambda: MockShell())
+    tool_manager_module.ToolManager._instance = None
+    tool_manager_module.DataManager._instance = None
+    EventManager._instance = None
+
+    yield tool_manager_module.ToolManager.instance()
+
+    tool_manager_module.ToolManager._instance = None
+    tool_manager_module.DataManager._instance = None
+    EventManager._instance = None
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (c) Regents of the University of California & the Broad Institute.
+# Distributed under the terms of the Modified BSD License.
+
+import asyncio
+import gc
+import threading
+from threading import Event
+from ..event_manager import EventManager
+from ..tool_manager import ToolManager, NBTool
+
+
+def test_unsubscribe_and_once():
+    events = EventManager()
+    calls = []
+    subscription = events.register('test', lambda data: calls.append(('always', data)))
+    events.register('test', lambda data: calls.append(('once', data)), once=True)
+    events.dispatch('test', 1)
+    events.dispatch('test', 2)
+    subscription.unsubscribe()
+    events.dispatch('test', 3)
+    assert calls == [('always', 1), ('once', 1), ('always', 2)] and events.subscribers('test') == 0
+
+
+def test_weak_subscriptions():
+    class Listener(object):
+        def __init__(self): self.calls = []
+        def receive(self, data): self.calls.append(data)
+
+    events = EventManager()
+    listener = Listener()
+    events.register('test', listener.receive, weak=True)
+    events.dispatch('test', 1)
+    assert listener.calls == [1]
+    del listener
+    gc.collect()
+    assert events.subscribers('test') == 0
+
+
+def test_placeholders_unsubscribe(tool_manager):
+    events = EventManager.instance()
+    outputs = [ToolManager.create_placeholder_widget('Remote', i) for i in ('a', 'b')]
+    assert events.subscribers('nbtools.register', key=('Remote', 'a')) == 1
+
+    ToolManager.register(NBTool(origin='Remote', id='a', name='A'))
+    assert events.subscribers('nbtools.register', key=('Remote', 'a')) == 0
+    assert events.subscribers('nbtools.register', key=('Remote', 'b')) == 1
+
+    # Placeholders which are closed and garbage collected stop listening
+    for output in outputs: output.close()
+    del outputs, output
+    gc.collect()
+    assert events.subscribers('nbtools.register', key=('Remote', 'b')) == 0 and not events.keyed
+
+
+def test_keyed_routing(tool_manager):
+    events = EventManager.instance()
+    calls = []
+    events.register('nbtools.register', lambda data: calls.append(('all', data['id'])))
+    for i in range(3): events.register('nbtools.register', lambda data: calls.append(('keyed', data['id'])),
+                                       key=('A', f't{i}'))
+
+    ToolManager.register(NBTool(origin='A', id='t0'))
+    with ToolManager.batch():  # Batched events are still routed by key
+        for i in (1, 5): ToolManager.register(NBTool(origin='A', id=f't{i}'))
+    assert calls == [('all', 't0'), ('keyed', 't0'), ('keyed', 't1')]
+
+
+def test_callback_errors_are_isolated(caplog):
+    events = EventManager()
+    calls = []
+    def fail(data): raise RuntimeError('callback failed')
+    events.register('test', fail)
+    events.register('test', lambda data: calls.append(data))
+    events.dispatch('test', 1)
+    assert calls == [1] and 'callback failed' in caplog.text
+
+
+def test_thread_dispatch_and_coalescing():
+    events = EventManager()
+    events.configure(mode='thread', coalesce=0.05)
+    release, done = Event(), Event()
+    calls = []
+    def slow(data):
+        release.wait(timeout=5)
+        calls.append(data)
+    events.register('slow', slow)
+    events.register('keyed', lambda data: (calls.append(data), done.set()), key='k')
+
+    events.dispatch('slow', 'slow')  # Doesn't block the dispatching thread
+    for i in range(5): events.dispatch('keyed', i, key='k')
+    release.set()
+    assert done.wait(timeout=5) and calls == ['slow', 4]  # Repeats of the keyed event are merged
+
+
+def test_async_dispatch():
+    async def run():
+        events = EventManager()
+        events.configure(mode='async')
+        calls = []
+        events.register('test', lambda data: calls.append((data, threading.get_ident())))
+        events.dispatch('test', 1)
+        assert calls == []  # Scheduled on the loop, not run during dispatch
+        await asyncio.sleep(0.01)
+        return calls
+
+    assert asyncio.run(run()) == [(1, threading.get_ident())]
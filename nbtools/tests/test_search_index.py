@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (c) Regents of the University of California & the Broad Institute.
+# Distributed under the terms of the Modified BSD License.
+
+from ..search_index import SearchIndex
+from ..tool_manager import ToolManager, NBTool
+
+
+def test_prefix_search_ranking():
+    index = SearchIndex()
+    index.add(('GP', 'a'), {'name': 'PreprocessDataset', 'description': 'Filter a dataset', 'origin': 'GP'})
+    index.add(('GP', 'b'), {'name': 'ComparativeMarkerSelection', 'description': 'Find markers in a dataset',
+                            'tags': ['preprocess'], 'origin': 'GP'})
+    assert index.search('preprocess') == [('GP', 'a'), ('GP', 'b')]  # Name match beats tag match
+    assert index.search('preproc') == [('GP', 'a'), ('GP', 'b')]
+    assert index.search('dataset') == [('GP', 'a'), ('GP', 'b')]  # Camel case name part beats description
+    assert index.search('mark data') == [('GP', 'b')]
+    assert index.search('') == []
+
+
+def test_remove_and_replace():
+    index = SearchIndex()
+    index.add('a', {'name': 'Alpha'})
+    index.add('a', {'name': 'Beta'})
+    assert index.search('alpha') == [] and index.search('beta') == ['a']
+    index.remove('a')
+    assert index.search('beta') == [] and index.tokens == []
+
+
+def test_tool_manager_search(tool_manager):
+    ToolManager.register(NBTool(origin='Notebook', id='a', name='Heatmap Viewer'), skip_update=True)
+    ToolManager.register(NBTool(origin='Notebook', id='b', name='Clustering'), skip_update=True)
+    assert [t.id for t in ToolManager.search('heat')] == ['a']
+    ToolManager.unregister('Notebook', 'a')
+    assert ToolManager.search('heat') == []
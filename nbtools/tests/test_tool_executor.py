@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (c) Regents of the University of California & the Broad Institute.
+# Distributed under the terms of the Modified BSD License.
+
+import os
+import pytest
+import sys
+import time
+from threading import Event, Lock
+from .. import form, parsing_manager, tool_executor, utils
+from ..uibuilder import UIBuilder, build_ui
+
+
+class DisplayPublisher(object):
+    """Stand-in for the shell's display publisher, recording what is displayed in the executing cell"""
+
+    def __init__(self): self.published = []
+    def publish(self, data, metadata=None, **kwargs): self.published.append(data)
+    def clear_output(self, wait=False): self.published = []
+
+
+class Shell(object):
+    """Stand-in for the IPython shell, recording the variables pushed to the user namespace"""
+
+    def __init__(self):
+        self.user_global_ns = {}
+        self.display_pub = DisplayPublisher()
+
+    def push(self, variables): self.user_global_ns.update(variables)
+
+
+@pytest.fixture
+def shell(monkeypatch):
+    shell = Shell()
+    monkeypatch.setattr(form, 'get_ipython', lambda: shell)
+    monkeypatch.setattr(parsing_manager, 'get_ipython', lambda: shell)
+    monkeypatch.setattr(tool_executor, 'get_ipython', lambda: shell)
+    monkeypatch.setattr(utils.UsageTracker, 'enabled', False)  # Don't report test runs
+    return shell
+
+
+def process_tool(n=3):
+    """Module level so worker processes can import it"""
+    sys.stdout.isatty() and sys.stderr.encoding  # Stream attributes used by progress bars and logging handlers
+    for i in range(int(n)): print(f'step {i}')
+    return os.getpid()
+
+
+@build_ui(execution='process', register_tool=False)
+def decorated_process_tool(n=2):
+    """Module level and decorated, the module attribute is the decorator's wrapper"""
+    return process_tool(n)
+
+
+def wait_until_idle(tool, timeout=5):
+    start = time.time()
+    while tool.busy and time.time() - start < timeout: time.sleep(0.01)
+    return not tool.busy
+
+
+def test_thread_execution(shell):
+    release = Event()
+    def slow_tool(x='a'):
+        print('working')
+        shell.display_pub.publish({'text/plain': 'figure'})  # As display() does
+        release.wait(timeout=5)
+        return x * 2
+
+    tool = UIBuilder(slow_tool, execution='thread')
+    tool.form.form.children[-1].value = 'result'  # The output_var input
+    tool.form.form.update()
+    assert tool.busy and 'result' not in shell.user_global_ns  # update() returns while the call runs
+    assert tool.form.form.manual_button.disabled  # Can't be run again until the call completes
+
+    shell.display_pub.publish({'text/plain': 'cell'})  # Displays from the kernel thread go to the executing cell
+    release.set()
+    assert wait_until_idle(tool) and shell.user_global_ns['result'] == 'aa'
+    assert not tool.form.form.manual_button.disabled
+    assert list(tool.output.outputs) == [{'name': 'stdout', 'output_type': 'stream', 'text': 'working\n'},
+                                         {'output_type': 'display_data', 'data': {'text/plain': 'figure'}, 'metadata': {}}]
+    assert shell.display_pub.published == [{'text/plain': 'cell'}]
+
+
+def test_thread_execution_errors(shell):
+    def failing_tool():
+        raise RuntimeError('tool failed')
+
+    tool = UIBuilder(failing_tool, execution='thread')
+    tool.form.form.children[-1].value = 'result'  # The output_var input
+    tool.form.form.update()
+    assert wait_until_idle(tool) and 'result' not in shell.user_global_ns
+    assert any('tool failed' in o['text'] for o in tool.output.outputs if o.get('name') == 'stderr')
+
+
+def test_process_execution(shell):
+    tool = UIBuilder(process_tool, execution='process')
+    tool.form.form.children[-1].value = 'result'
+    tool.form.form.update()
+    assert wait_until_idle(tool, timeout=30) and shell.user_global_ns['result'] != os.getpid()
+    assert [o['text'] for o in tool.output.outputs] == ['step 0\n', 'step 1\n', 'step 2\n']
+
+
+@pytest.mark.parametrize('pickler', [tool_executor.cloudpickle, None])
+def test_process_execution_decorated(shell, monkeypatch, pickler):
+    monkeypatch.setattr(tool_executor, 'cloudpickle', pickler)  # Sent by name, with or without cloudpickle
+    tool = decorated_process_tool.__widget__
+    tool.output.outputs = ()
+    tool.form.form.children[-1].value = 'result'
+    tool.form.form.update()
+    assert wait_until_idle(tool, timeout=30) and shell.user_global_ns['result'] != os.getpid()
+    assert [o['text'] for o in tool.output.outputs] == ['step 0\n', 'step 1\n']
+
+    # Functions pickled by value leave their widgets behind
+    copy = tool_executor._without_widget(tool.function_or_method)
+    assert not hasattr(copy, '__widget__') and copy(n=0) == os.getpid()
+
+
+def test_process_execution_falls_back_to_threads(shell):
+    lock = Lock()
+    def unpicklable_tool():
+        with lock: return 'done'
+
+    tool = UIBuilder(unpicklable_tool, execution='process')
+    tool.form.form.children[-1].value = 'result'
+    tool.form.form.update()
+    assert wait_until_idle(tool) and shell.user_global_ns['result'] == 'done'
+    assert "running it in a thread instead" in tool.output.outputs[0]['text']
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (c) Regents of the University of California & the Broad Institute.
+# Distributed under the terms of the Modified BSD License.
+
+import gc
+import json
+import pytest
+import zlib
+from threading import Event
+from ..event_manager import EventManager
+from ..tool_manager import ChangeLog, ToolManager, NBTool, Data, DataManager
+
+
+class RecordingComm:
+    """Comm stand-in which records the messages sent to the client, blocking until the gate is opened"""
+
+    def __init__(self, gate_open=True):
+        self.comm_id = str(id(self))
+        self.sent = []
+        self.buffers = []
+        self.gate = Event()
+        if gate_open: self.gate.set()
+        self.receive = self.close = None
+
+    def send(self, message, buffers=None):
+        self.gate.wait()
+        self.sent.append(message)
+        self.buffers.append(buffers)
+
+    def on_msg(self, callback):
+        self.receive = lambda data: callback({'content': {'data': data}})
+
+    def on_close(self, callback):
+        self.close = lambda: callback({})
+
+
+def test_change_log_since():
+    log = ChangeLog()
+    log.record('tools', ('Notebook', 'a'))
+    log.record('tools', ('Notebook', 'b'))
+    log.record('tools', ('Notebook', 'a'), removed=True)
+    assert log.version == 3
+    assert log.since(1) == [('tools', ('Notebook', 'b'), False), ('tools', ('Notebook', 'a'), True)]
+    assert log.since(3) == []
+
+
+def test_change_log_floor(monkeypatch):
+    monkeypatch.setattr(ChangeLog, 'LIMIT', 2)
+    log = ChangeLog()
+    for uri in ['a', 'b', 'c']: log.record('data', ('Notebook', uri))
+    assert not log.covers(0)
+    assert log.covers(1)
+
+
+def test_delta_update(tool_manager):
+    tool_manager.register(NBTool(origin='Notebook', id='a', name='A'), skip_update=True)
+    version = tool_manager.changes.version
+    tool_manager.register(NBTool(origin='Notebook', id='b', name='B'), skip_update=True)
+    DataManager.register(Data(origin='Notebook', uri='file.txt'), skip_update=True)
+    tool_manager.unregister('Notebook', 'a')
+
+    client = tool_manager.add_client(RecordingComm())
+    delta, _, _ = tool_manager._encode(tool_manager._delta(version), client)
+    assert [t['id'] for t in delta['tools']] == ['b']
+    assert [d['uri'] for d in delta['data']] == ['file.txt']
+    assert delta['removed']['tools'] == [('Notebook', 'a')]
+    assert delta['version'] == tool_manager.changes.version
+
+    snapshot, _, _ = tool_manager._encode(tool_manager._snapshot(), client)
+    assert [t['id'] for t in snapshot['tools']] == ['b']
+    assert 'since' not in snapshot
+
+
+def test_sender_coalesces_updates(tool_manager):
+    comm = RecordingComm(gate_open=False)  # Messages queue up behind the first send
+    tool_manager.add_client(comm)
+    tool_manager.send('notification', {'message': 'start'})
+    tool_manager.send('update', {'version': 1})
+    tool_manager.send('update', {'version': 2})
+    tool_manager.send('notification', {'message': 'done'})
+    comm.gate.set()
+    assert tool_manager.sender.flush(timeout=5)
+
+    updates = [m for m in comm.sent if m['func'] == 'update']
+    assert updates == [{'func': 'update', 'payload': {'version': 2}}]
+    assert comm.sent[-1]['func'] == 'notification'
+
+
+def test_batch_defers_updates_and_merges_events(tool_manager, monkeypatch):
+    updates, events = [], []
+    monkeypatch.setattr(tool_manager, 'send_update', lambda: updates.append(tool_manager.changes.version))
+    EventManager.instance().register('nbtools.register', lambda data: events.append(('single', data['id'])))
+    EventManager.instance().register('nbtools.register_batch',
+                                     lambda data: events.append(('batch', [e['id'] for e in data['events']])))
+
+    with ToolManager.batch():
+        ToolManager.register(NBTool(origin='Notebook', id='a', name='A'))
+        with DataManager.batch():
+            ToolManager.register(NBTool(origin='Notebook', id='b', name='B'))
+            DataManager.register(Data(origin='Notebook', uri='file.txt'))
+        assert updates == [] and events == []
+
+    assert updates == [3]
+    assert events == [('batch', ['a', 'b'])]
+
+
+def test_json_cache_invalidation(tool_manager):
+    nbtool = NBTool(origin='Notebook', id='a', name='A')
+    assert nbtool.json_safe() is nbtool.json_safe()
+    assert json.loads(nbtool.json_fragment()) == nbtool.json_safe()
+
+    nbtool.name = 'Renamed'
+    assert nbtool.json_safe()['name'] == 'Renamed'
+    assert '"Renamed"' in nbtool.json_fragment()
+
+    data = Data(origin='Notebook', uri='file.txt')
+    DataManager.register(data, skip_update=True)
+    assert not data.json_safe()['widget']
+    DataManager.data_widget('Notebook', 'file.txt', widget=lambda: None)
+    assert data.json_safe()['widget']
+
+
+def test_compressed_update(tool_manager, monkeypatch):
+    monkeypatch.setattr(ToolManager, 'COMPRESSION_THRESHOLD', 100)
+    for i in range(10): ToolManager.register(NBTool(origin='Notebook', id=str(i), name=f'Tool {i}'), skip_update=True)
+
+    client = tool_manager.add_client(RecordingComm())
+    payload, buffers, size = tool_manager._encode(tool_manager._snapshot(), client)
+    assert buffers is None  # The client hasn't negotiated compression
+    assert abs(size - len(json.dumps(payload))) < 0.05 * size  # Measured from the fragments
+
+    client.encodings = ['zlib']
+    payload, buffers, _ = tool_manager._encode(tool_manager._snapshot(), client)
+    assert payload['encoding'] == 'zlib' and 'tools' not in payload
+    body = json.loads(zlib.decompress(buffers[0]))
+    assert [t['id'] for t in body['tools']] == [str(i) for i in range(10)]
+    assert body['origins'] == [] and body['data'] == []
+
+
+def test_request_update_with_cached_version(tool_manager):
+    comm = RecordingComm()
+    tool_manager.add_client(comm)
+    ToolManager.register(NBTool(origin='Notebook', id='a', name='A'), skip_update=True)
+    version = tool_manager.changes.version
+
+    def request_update(payload):
+        comm.receive({'func': 'request_update', 'payload': payload})
+        tool_manager.sender.flush(timeout=5)
+        return comm.sent[-1]['payload']
+
+    payload = request_update({'registry': tool_manager.registry_id, 'version': version})
+    assert payload['unchanged'] and payload['version'] == version
+
+    ToolManager.register(NBTool(origin='Notebook', id='b', name='B'), skip_update=True)
+    payload = request_update({'registry': tool_manager.registry_id, 'version': version})
+    assert payload['since'] == version and [t['id'] for t in payload['tools']] == ['b']
+
+    payload = request_update({'registry': 'restarted kernel', 'version': version})
+    assert 'since' not in payload and len(payload['tools']) == 2
+
+
+def test_fan_out_to_clients(tool_manager):
+    first, second = RecordingComm(), RecordingComm()
+    tool_manager.add_client(first)
+    tool_manager.add_client(second)
+    first.receive({'func': 'request_update', 'payload': {}})
+    tool_manager.sender.flush(timeout=5)
+    first.receive({'func': 'ack', 'payload': {'version': tool_manager.changes.version}})
+
+    ToolManager.register(NBTool(origin='Notebook', id='a', name='A'))
+    tool_manager.sender.flush(timeout=5)
+    assert 'since' in first.sent[-1]['payload']       # The first client only needs the change
+    assert 'since' not in second.sent[-1]['payload']  # The second client hasn't received anything yet
+
+    second.close()
+    ToolManager.register(NBTool(origin='Notebook', id='b', name='B'))
+    tool_manager.sender.flush(timeout=5)
+    assert len(first.sent) == 3 and len(second.sent) == 1
+
+
+def test_stub_listing(tool_manager):
+    ToolManager.register(NBTool(origin='Notebook', id='a', name='A', description='Long description', tags=['x']),
+                         skip_update=True)
+    client = tool_manager.add_client(RecordingComm())
+    client.stubs = True
+    payload, _, _ = tool_manager._encode(tool_manager._snapshot(), client)
+    assert payload['stubs'] and payload['tools'] == [{'origin': 'Notebook', 'id': 'a', 'name': 'A', 'version': None}]
+
+    tool_manager.tools['Notebook']['a'].name = 'Renamed'
+    assert tool_manager.tools['Notebook']['a'].json_stub()['name'] == 'Renamed'
+
+
+def test_origin_button_runs_off_the_comm_handler(tool_manager):
+    comm = RecordingComm()
+    tool_manager.add_client(comm)
+    release, calls, done = Event(), [], Event()
+
+    def refresh(option):
+        release.wait(5)
+        calls.append(option)
+        if len(calls) == 2: done.set()
+
+    ToolManager.register_callback('refresh', refresh)
+    comm.receive({'func': 'origin_button', 'payload': {'name': 'refresh', 'option': 1}})
+    comm.receive({'func': 'origin_button', 'payload': {'name': 'refresh', 'option': 2}})
+    assert calls == [] and tool_manager.callbacks['refresh'].waiting  # Returned immediately, second call waiting
+
+    release.set()
+    assert done.wait(5) and calls == [1, 2]
+
+
+def test_comm_handler_errors_are_reported(tool_manager):
+    comm = RecordingComm()
+    tool_manager.add_client(comm)
+    finished = Event()
+
+    async def failing(client, payload):
+        finished.set()
+        raise RuntimeError('job list unavailable')
+
+    ToolManager.register_comm_handler('refresh_jobs', failing, mode='async')
+    comm.receive({'func': 'refresh_jobs', 'payload': {}})
+    assert finished.wait(5)
+    tool_manager.executor.shutdown(wait=True)
+    tool_manager.sender.flush(timeout=5)
+    assert comm.sent[-1]['func'] == 'notification'
+    assert 'job list unavailable' in comm.sent[-1]['payload']['message']
+
+
+def test_stats(tool_manager):
+    comm = RecordingComm()
+    tool_manager.add_client(comm)
+    comm.receive({'func': 'request_update', 'payload': {}})
+    ToolManager.register(NBTool(origin='Notebook', id='a', name='A', description='x' * 1000))
+    tool_manager.sender.flush(timeout=5)
+
+    stats = ToolManager.stats()
+    assert stats['clients'] == 1 and stats['received'] == {'request_update': 1}
+    assert stats['updates']['count'] == 2
+    assert stats['sent']['update']['count'] + stats['coalesced'] == 2
+    assert stats['largest'][0]['bytes'] > 1000
+
+    ToolManager.reset_stats()
+    assert ToolManager.stats()['updates']['count'] == 0 and ToolManager.stats()['largest'] == []
+
+
+def test_data_indexes(tool_manager):
+    DataManager.register_all([Data(origin='A', uri=f'a{i}', kind=['gct', 'csv'][i % 2], group='g1') for i in range(6)])
+    DataManager.register(Data(origin='B', uri='b0', kind='csv', group='g2', label='B0'))
+
+    assert DataManager.instance().get('A', 'a3').kind == 'csv' and DataManager.instance().get('A', 'x') is None
+    assert [d.uri for d in DataManager.filter(kinds=['csv'], origin='A')] == ['a1', 'a3', 'a5']
+    assert [d.uri for d in DataManager.query(kinds=['gct', 'csv'], groups=['g2'])] == ['b0']
+    assert [d.uri for d in DataManager.filter(kind='csv', label='B0')] == ['b0']
+
+    # Indexes follow changes to registered data
+    DataManager.instance().get('A', 'a0').kind = 'csv'
+    DataManager.register(Data(origin='A', uri='a1', kind='gct', group='g1'))
+    DataManager.unregister('A', 'a5')
+    assert [d.uri for d in DataManager.filter(kinds=['csv'], group='g1')] == ['a0', 'a3']  # In registry order
+    DataManager.unregister_all('A')
+    assert [d.uri for d in DataManager.filter(kinds=['csv', 'gct'])] == ['b0']
+
+
+def test_data_eviction(tool_manager):
+    comm = RecordingComm()
+    tool_manager.add_client(comm)
+    DataManager.set_limits(max_per_origin=3, max_total=2, pinned=['Pinned'])
+    DataManager.register_all([Data(origin='Pinned', uri=f'p{i}') for i in range(4)])
+    DataManager.register_all([Data(origin='A', uri=f'a{i}', group='g') for i in range(3)])
+    DataManager.group_widget('A', 'g', widget=object())
+    DataManager.data_widget('A', 'a1', widget=object())
+    assert DataManager.exists('a0', 'A') is False and len(DataManager.list()) == 6  # Pinned data isn't counted
+
+    # Recently used data is kept, evicted data loses its widget
+    DataManager.instance().get('A', 'a1')
+    DataManager.register(Data(origin='B', uri='b0'))
+    assert [d.uri for d in DataManager.filter(origin='A')] == ['a1'] and DataManager.data_widget('A', 'a1')
+    DataManager.set_limits(max_total=1, pinned=['Pinned'])
+    assert not DataManager.exists('b0', 'B')  # Getting the widget used a1 more recently
+    DataManager.set_limits(max_total=0, pinned=['Pinned'])
+    assert DataManager.data_widget('A', 'a1') is None and DataManager.group_widget('A', 'g') is None
+    assert len(DataManager.list()) == 4
+
+    # Data evicted as soon as it's registered isn't announced
+    registered = []
+    EventManager.instance().register('nbtools.data_register', lambda data: registered.append(data['id']))
+    DataManager.register(Data(origin='Pinned', uri='p4'))
+    DataManager.register(Data(origin='B', uri='b0'))
+    assert registered == ['p4'] and not DataManager.exists('b0', 'B')
+    DataManager.unregister('Pinned', 'p4')
+
+    # Expired data is evicted in a single update
+    DataManager.set_limits(pinned=['Pinned'])
+    DataManager.register_all([Data(origin='B', uri=f'b{i}') for i in range(3)])
+    tool_manager.sender.flush(timeout=5)
+    sent = len(comm.sent)
+    DataManager.set_limits(ttl=0)
+    tool_manager.sender.flush(timeout=5)
+    assert [d.origin for d in DataManager.list()] == ['Pinned'] * 4 and len(comm.sent) == sent + 1
+    DataManager.set_limits()
+
+
+def test_widget_cache(tool_manager):
+    class Widget(object):
+        comm = 'open'
+
+    built = []
+    def factory():
+        built.append(Widget())
+        return built[-1]
+
+    DataManager.group_widget('A', 'g', widget=factory)
+    first = DataManager.group_widget('A', 'g')
+    assert DataManager.group_widget('A', 'g') is first and len(built) == 1  # Memoized
+
+    first.comm = None  # Closed widgets are rebuilt
+    assert DataManager.group_widget('A', 'g') is not first and len(built) == 2
+    del first, built[:]  # Garbage collected widgets are rebuilt
+    assert DataManager.group_widget('A', 'g') is not None
+    assert DataManager.widget_stats()['groups'] == {'entries': 1, 'hits': 1, 'misses': 3}
+
+    # Widgets stored directly are held until they are closed
+    widget = Widget()
+    DataManager.data_widget('A', 'a', widget=widget)
+    del widget
+    gc.collect()
+    widget = DataManager.data_widget('A', 'a')
+    assert widget is not None
+    widget.comm = None
+    assert DataManager.data_widget('A', 'a') is None
+
+
+def test_unregister_where(tool_manager):
+    DataManager.register_all([Data(origin='A', uri=f'job1/{i}.csv', kind='csv', group='job1') for i in range(100)])
+    DataManager.register_all([Data(origin='A', uri=f'job2/{i}.gct', kind='gct', group='job2') for i in range(3)])
+    DataManager.group_widget('A', 'job1', widget=lambda: 'widget')
+    DataManager.data_widget('A', 'job1/0.csv', widget=lambda: 'widget')
+    updates = ToolManager.stats()['updates']['count']
+
+    assert DataManager.unregister_where(origin='A', group='job1') == 100
+    assert DataManager.group_widget('A', 'job1') is None and DataManager.data_widget('A', 'job1/0.csv') is None
+    assert DataManager.unregister_where(uri_prefix='job2/', predicate=lambda d: d.uri != 'job2/0.gct') == 2
+    assert DataManager.unregister_where(kind='csv') == 0
+    assert [d.uri for d in DataManager.list()] == ['job2/0.gct']
+    assert ToolManager.stats()['updates']['count'] == updates + 2  # One update for each call which removed data
+
+    with pytest.raises(ValueError): DataManager.unregister_where()  # Unregistering everything must be explicit
+    assert DataManager.unregister_where(origin='A') == 1 and not DataManager.origin_exists('A')
+
+
+def test_registry_snapshot(tool_manager, tmp_path):
+    path = str(tmp_path / 'registry.sqlite')
+    ToolManager.enable_snapshot(path, grace=None)
+    ToolManager.register_all([NBTool(origin='Remote', id=i, name=f'Tool {i}') for i in ('a', 'b')])
+    DataManager.register(Data(origin='Remote', uri='x.csv', kind='csv'))
+    ToolManager.unregister('Remote', 'b')
+    tool_manager.write_snapshot()
+
+    # A restarted kernel lists the saved entries as stale until they are registered again
+    ToolManager._instance = DataManager._instance = None
+    comm = RecordingComm()
+    client = ToolManager.instance().add_client(comm)
+    client.version = ToolManager.instance().changes.version  # Up to date before the snapshot is restored
+    ToolManager.enable_snapshot(path, grace=None)
+    snapshot = ToolManager.instance()._snapshot()
+    assert snapshot['stale'] and [t.id for t in snapshot['tools']] == ['a'] and snapshot['data'][0].kind == 'csv'
+    delta = ToolManager.instance()._delta(client.version)
+    assert delta['stale'] and [t.id for t in delta['tools']] == ['a'] and delta['data'][0].kind == 'csv'
+
+    ToolManager.register(NBTool(origin='Remote', id='a', name='Tool A'))
+    client.version = ToolManager.instance().changes.version
+    ToolManager.confirm_snapshot('Remote')
+    delta = ToolManager.instance()._delta(client.version)
+    assert 'stale' not in delta and delta['removed']['data'] == [('Remote', 'x.csv')]
+    assert [t.name for t in ToolManager.instance()._snapshot()['tools']] == ['Tool A']
+    tool_manager.snapshot = ToolManager.instance().snapshot = None  # Stop any pending writes
+
+
+def test_snapshot_per_notebook(tool_manager, monkeypatch):
+    monkeypatch.delenv('JPY_SESSION_NAME', raising=False)
+    ToolManager.enable_snapshot()
+    assert tool_manager.snapshot is None  # Kernels of unknown notebooks don't share a default snapshot
+
+    paths = []
+    for session in ('a.ipynb', 'b.ipynb'):
+        monkeypatch.setenv('JPY_SESSION_NAME', session)
+        paths.append(ToolManager._snapshot_path())
+    assert paths[0] != paths[1]
+
+
+def test_data_probe(tool_manager, tmp_path):
+    path = tmp_path / 'input.txt'
+    path.write_bytes(b'x' * 3000)
+    probed = []
+    done = Event()
+    def on_probe(data):
+        probed.append(data)
+        if len(probed) == 2: done.set()
+    EventManager.instance().register('nbtools.data_probe', on_probe)
+
+    DataManager.enable_probing(algorithm='sha256')
+    DataManager.register_all([Data(origin='A', uri=str(path)), Data(origin='A', uri=path.as_uri()),
+                              Data(origin='A', uri='https://example.com/input.txt')])
+    assert done.wait(timeout=5)
+
+    data = DataManager.instance().get('A', str(path))
+    assert data.size == 3000 and data.modified == path.stat().st_mtime
+    assert data.checksum == DataManager.instance().get('A', path.as_uri()).checksum == probed[0]['checksum']
+    assert len(DataManager.instance().probe.checksums) == 1  # Checksums are cached by path, mtime and size
+    assert DataManager.instance().get('A', 'https://example.com/input.txt').size is None
+    DataManager.disable_probing()
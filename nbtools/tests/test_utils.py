@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (c) Regents of the University of California & the Broad Institute.
+# Distributed under the terms of the Modified BSD License.
+
+import pytest
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from .. import utils
+
+
+class FileServer(ThreadingHTTPServer):
+    """Local stand-in for a remote file server, serving a body per path and counting requests"""
+
+    def __init__(self):
+        self.files = {}         # path -> (body, etag)
+        self.requests = []      # (path, status) of each request served
+        self.delay = 0          # Seconds to wait before responding
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                time.sleep(self.delay)
+                body, etag = self.files[handler.path]
+                if handler.headers.get('If-None-Match') == etag:
+                    self.requests.append((handler.path, 304))
+                    handler.send_response(304)
+                    handler.end_headers()
+                    return
+                self.requests.append((handler.path, 200))
+                handler.send_response(200)
+                handler.send_header('ETag', etag)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args): pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_address[1]}{path}'
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def url_cache(tmp_path):
+    utils.configure_url_cache(directory=str(tmp_path / 'cache'))
+    yield utils.url_cache()
+    utils.configure_url_cache(enabled=False)
+
+
+def test_url_cache_revalidates(server, url_cache):
+    server.files['/result.gct'] = (b'a' * 5000, '"v1"')
+    with utils.open(server.url('/result.gct')) as f: assert f.read() == b'a' * 5000
+    with utils.open(server.url('/result.gct')) as f: assert f.read() == b'a' * 5000
+
+    server.files['/result.gct'] = (b'b' * 10, '"v2"')
+    with utils.open(server.url('/result.gct')) as f: assert f.read() == b'b' * 10
+    assert server.requests == [('/result.gct', 200), ('/result.gct', 304), ('/result.gct', 200)]
+
+    # Offline, the cached copy is used without contacting the server
+    url_cache.offline = True
+    with utils.open(server.url('/result.gct')) as f: assert f.read() == b'b' * 10
+    with pytest.raises(urllib.error.URLError): utils.open(server.url('/missing.gct'))
+    assert len(server.requests) == 3
+
+
+def test_url_cache_shares_downloads(server, url_cache):
+    server.files['/result.gct'] = (b'c' * 100000, '"v1"')
+    server.delay = 0.2
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        bodies = list(executor.map(lambda _: utils.open(server.url('/result.gct')).read(), range(4)))
+    assert bodies == [b'c' * 100000] * 4 and server.requests == [('/result.gct', 200)]
+
+
+def test_url_cache_evicts_least_recently_used(server, url_cache):
+    url_cache.max_size = 2500
+    for path in ('/a', '/b', '/c'): server.files[path] = (b'x' * 1000, '"v1"')
+    for path in ('/a', '/b', '/a', '/c'): utils.open(server.url(path)).close()
+    assert [e['url'] for e in url_cache.entries.values()] == [server.url('/a'), server.url('/c')]
+    assert url_cache.size == 2000
+
+
+def test_url_cache_unavailable(server, tmp_path, monkeypatch, caplog):
+    unwritable = tmp_path / 'file'
+    unwritable.write_bytes(b'')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(unwritable))
+    server.files['/result.gct'] = (b'd' * 10, '"v1"')
+    utils.configure_url_cache()
+    try:  # URLs are read directly when the cache can't be created
+        with utils.open(server.url('/result.gct'), mode='binary') as f: assert f.read() == b'd' * 10
+        assert utils.url_cache() is None and 'unable to create the URL cache' in caplog.text
+    finally: utils.configure_url_cache(enabled=False)
+
+
+def test_open_modes(server, url_cache, tmp_path):
+    path = tmp_path / 'matrix.gct'
+    path.write_bytes(b'#1.2\n' + b'0123456789' * 500)
+    content = path.read_bytes()
+
+    with utils.open(str(path)) as f: assert f.read() == content.decode()
+    with utils.open(str(path), mode='binary') as f: assert f.read() == content
+    assert b''.join(bytes(c) for c in utils.open(str(path), mode='chunks', chunk_size=1024)) == content
+    with utils.open(str(path), mode='mmap') as m: assert m[:4] == b'#1.2' and memoryview(m).nbytes == len(content)
+
+    # URLs can be streamed in chunks, with or without the cache
+    server.files['/matrix.gct'] = (content, '"v1"')
+    for cache in (True, False):
+        chunks = utils.open(server.url('/matrix.gct'), mode='chunks', cache=cache, chunk_size=1024)
+        assert b''.join(bytes(c) for c in chunks) == content
+    with utils.open(server.url('/matrix.gct'), mode='mmap') as m: assert m[-10:] == b'0123456789'
+    with pytest.raises(ValueError): utils.open(server.url('/matrix.gct'), mode='mmap', cache=False)
+
+
+def test_usage_tracker(server, monkeypatch):
+    server.files['/usage/tool_run/'] = (b'', '"v1"')
+    tracker = utils.UsageTracker(endpoint=server.url('/usage/'), max_pending=3)
+    for _ in range(5): tracker.track('tool_run', 'Notebook|a|A')
+    assert tracker.flush(timeout=5)
+    assert server.requests == [('/usage/tool_run/', 200)] * 3 and (tracker.sent, tracker.dropped) == (3, 2)
+
+    # Requests stop once the endpoint fails, and nothing is counted while tracking is off
+    tracker.endpoint = 'http://127.0.0.1:1/usage/'
+    tracker.track('tool_run')
+    assert tracker.flush(timeout=5) and tracker.dropped == 3
+    monkeypatch.setattr(utils.UsageTracker, 'enabled', False)
+    tracker.track('tool_run')
+    assert tracker.pending == 0
@@ -0,0 +1,292 @@
+import importlib
+import multiprocessing
+import pickle
+import sys
+import types
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock, Thread, get_ident
+from IPython import get_ipython
+from ipywidgets.widgets.interaction import show_inline_matplotlib_plots
+
+try: import cloudpickle  # Optional, allows functions defined in the notebook to run in a worker process
+except ImportError: cloudpickle = None
+
+
+class LineBuffer(object):
+    """
+    Collects text written to a stream, passing it on a line at a time so each print() isn't sent separately. Other
+    stream attributes, such as encoding or isatty(), are read from the stream it stands in for, if any.
+    """
+
+    def __init__(self, append, stream=None):
+        self.append = append        # Function called with complete lines of text
+        self.stream = stream        # The stream this buffer stands in for
+        self.pending = ''           # Text written since the last complete line
+
+    def write(self, text):
+        self.pending += text
+        end = self.pending.rfind('\n') + 1
+        if end:
+            self.append(self.pending[:end])
+            self.pending = self.pending[end:]
+
+    def flush(self):
+        if self.pending: self.append(self.pending)
+        self.pending = ''
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__.get('stream'), name)
+
+
+class ThreadRoutedStream(object):
+    """
+    Stands in for sys.stdout or sys.stderr, sending writes made by registered threads to their own LineBuffer and
+    everything else to the stream it replaced
+    """
+
+    def __init__(self, stream):
+        self.stream = stream        # The stream which was replaced
+        self.routes = {}            # Thread ident -> LineBuffer of the text written by the thread
+
+    def write(self, text):
+        route = self.routes.get(get_ident())
+        if route is None: return self.stream.write(text)
+        route.write(text)
+        return len(text)
+
+    def flush(self):
+        route = self.routes.get(get_ident())
+        if route is None: self.stream.flush()
+        else: route.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ThreadRoutedDisplay(object):
+    """
+    Wraps the shell's display publisher, sending display() calls made by registered threads to a callback, rather
+    than to whichever cell is executing, and everything else to the original publisher
+    """
+
+    def __init__(self, publisher):
+        self.original = publisher.publish, publisher.clear_output  # The publisher's own methods
+        self.routes = {}            # Thread ident -> (function called with data and metadata, function clearing output)
+        publisher.publish, publisher.clear_output = self.publish, self.clear_output
+        publisher.nbtools_routes = self
+
+    def publish(self, data, metadata=None, *args, **kwargs):
+        route = self.routes.get(get_ident())
+        if route is None: return self.original[0](data, metadata, *args, **kwargs)
+        route[0](data, metadata or {})
+
+    def clear_output(self, wait=False):
+        route = self.routes.get(get_ident())
+        if route is None: return self.original[1](wait)
+        route[1]()
+
+
+class ToolExecutor(object):
+    """
+    Runs tool calls in the background, so the kernel stays responsive while they run. Anything the call prints or
+    displays is appended to the tool's Output widget rather than whichever cell is executing at the time.
+
+    Calls are run on a thread pool, or on a persistent pool of worker processes for CPU-bound tools which would
+    otherwise hold the GIL. Functions which can be imported are sent to worker processes by name, others are pickled
+    by value with cloudpickle if it's installed. Worker processes send what they print back over a queue. Functions
+    and arguments which can't be sent are run on the thread pool instead.
+    """
+    MODES = ('thread', 'process')   # Background execution modes
+    THREAD_WORKERS = 4              # Size of the thread pool
+    PROCESS_WORKERS = None          # Size of the process pool, None for one per CPU
+    _instance = None                # ToolExecutor singleton
+
+    @staticmethod
+    def instance():
+        if ToolExecutor._instance is None:
+            ToolExecutor._instance = ToolExecutor()
+        return ToolExecutor._instance
+
+    def __init__(self):
+        self.threads = None         # Thread pool running tool calls, lazily created
+        self.processes = None       # Process pool running tool calls, lazily created
+        self.queue = None           # Queue of (job, stream name, text) printed by worker processes
+        self.jobs = {}              # Job id -> [stdout LineBuffer, stderr LineBuffer, Future, worker's Future]
+        self.job_ids = count()      # Source of job ids
+        self.lock = Lock()          # Guards pool creation and replacing sys.stdout, sys.stderr and display
+
+    def submit(self, function, kwargs, output, mode='thread'):
+        """
+        Call the function with the keyword arguments in the background
+
+        :param function: the tool's function
+        :param kwargs: keyword arguments, already parsed from the form
+        :param output: Output widget that stdout and stderr of the call are appended to
+        :param mode: how the call is run, 'thread' to run it on a thread pool or 'process' to run it in a worker
+                     process, falling back to the thread pool if the function or arguments can't be pickled
+        :return: Future of the function's return value
+        """
+        if mode not in ToolExecutor.MODES: raise ValueError(f'Tool execution must be inline or one of {ToolExecutor.MODES}')
+        if mode == 'process':
+            try: return self._submit_process(function, kwargs, output)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                output.append_stderr(f'{getattr(function, "__qualname__", function)} can\'t be sent to a worker process '
+                                     f'({e}), running it in a thread instead\n')
+        with self.lock:
+            if self.threads is None:
+                self.threads = ThreadPoolExecutor(max_workers=ToolExecutor.THREAD_WORKERS, thread_name_prefix='nbtools-tool')
+        return self.threads.submit(self._call, function, kwargs, output)
+
+    def _submit_process(self, function, kwargs, output):
+        """Pickle the call and submit it to the process pool, raise an error if it can't be pickled"""
+        reference = _reference(function)
+        if reference is not None: payload = pickle.dumps((reference, kwargs))
+        elif cloudpickle is not None: payload = cloudpickle.dumps((_without_widget(function), kwargs))
+        else: raise pickle.PicklingError('functions which can\'t be imported by name need the cloudpickle package')
+
+        with self.lock:
+            if self.processes is None:
+                context = multiprocessing.get_context('spawn')  # Forking the kernel's threads isn't safe
+                self.queue = context.SimpleQueue()
+                self.processes = ProcessPoolExecutor(max_workers=ToolExecutor.PROCESS_WORKERS, mp_context=context,
+                                                     initializer=_init_worker, initargs=(self.queue,))
+                Thread(target=self._listen, args=(self.queue,), daemon=True, name='nbtools-tool-output').start()
+            job, queue, processes, result = next(self.job_ids), self.queue, self.processes, Future()
+            self.jobs[job] = [LineBuffer(output.append_stdout), LineBuffer(output.append_stderr), result, None]
+        try: future = processes.submit(_process_call, job, payload)
+        except BrokenProcessPool:
+            self._process_done(job, None, queue)  # A worker died, start a new pool for the next call
+            raise
+        future.add_done_callback(lambda future: self._process_done(job, future, queue))
+        return result
+
+    def _process_done(self, job, future, queue):
+        """Once the worker returns, queue a marker behind anything it printed, so output is shown before the result"""
+        if future is None or isinstance(future.exception(), BrokenProcessPool):
+            with self.lock:
+                if self.queue is queue: self.processes = None  # Start a new pool for the next call
+        if future is None: del self.jobs[job]
+        else:
+            self.jobs[job][3] = future
+            queue.put((job, None, None))
+
+    def _listen(self, queue):
+        """Append what worker processes print to the Output widgets of their calls, completing calls when marked"""
+        while True:
+            job, name, text = queue.get()
+            stdout, stderr, result, future = self.jobs[job]
+            if name == 'stdout': stdout.write(text)
+            elif name == 'stderr': stderr.write(text)
+            else:
+                del self.jobs[job]
+                stdout.flush()
+                stderr.flush()
+                if future.exception() is None: result.set_result(future.result())
+                else: result.set_exception(future.exception())
+
+    def shutdown(self):
+        """Stop running tool calls once the pending calls finish"""
+        with self.lock:
+            if self.threads: self.threads.shutdown(wait=False)
+            if self.processes: self.processes.shutdown(wait=False)
+            self.threads, self.processes = None, None
+
+    def _call(self, function, kwargs, output):
+        with self.capture(output):
+            result = function(**kwargs)
+            show_inline_matplotlib_plots()  # Display any figures the call created
+            return result
+
+    @contextmanager
+    def capture(self, output):
+        """Append what the current thread writes to stdout and stderr, or displays, to the Output widget"""
+        ident = get_ident()
+        stdout, stderr, display = self._routed('stdout'), self._routed('stderr'), self._routed_display()
+        stdout.routes[ident], stderr.routes[ident] = LineBuffer(output.append_stdout), LineBuffer(output.append_stderr)
+
+        def publish(data, metadata):
+            stdout.routes[ident].flush()  # Keep text printed before the display above it
+            stderr.routes[ident].flush()
+            output.outputs += ({'output_type': 'display_data', 'data': data, 'metadata': metadata},)
+
+        def clear():
+            stdout.routes[ident].pending = stderr.routes[ident].pending = ''
+            output.outputs = ()
+
+        if display: display.routes[ident] = (publish, clear)
+        try: yield
+        finally:
+            if display: display.routes.pop(ident)
+            stdout.routes.pop(ident).flush()
+            stderr.routes.pop(ident).flush()
+
+    def _routed(self, name):
+        """Return the ThreadRoutedStream standing in for sys.stdout or sys.stderr, installing it if necessary"""
+        with self.lock:
+            stream = getattr(sys, name)
+            if not isinstance(stream, ThreadRoutedStream):
+                stream = ThreadRoutedStream(stream)
+                setattr(sys, name, stream)
+            return stream
+
+    def _routed_display(self):
+        """Return the ThreadRoutedDisplay wrapping the shell's display publisher, or None if there is no shell"""
+        publisher = getattr(get_ipython(), 'display_pub', None)
+        if publisher is None: return None
+        with self.lock:
+            routed = getattr(publisher, 'nbtools_routes', None)
+            return routed if isinstance(routed, ThreadRoutedDisplay) else ThreadRoutedDisplay(publisher)
+
+
+def _resolve(module, qualname):
+    """Import the function by name, unwrapping the build_ui decorator to the tool's own function"""
+    function = importlib.import_module(module)
+    for name in qualname.split('.'): function = getattr(function, name)
+    widget = getattr(function, '__widget__', None)  # Set on functions decorated with build_ui
+    return getattr(widget, 'function_or_method', None) or function
+
+
+def _reference(function):
+    """Return the (module, qualname) the worker can import the function by, or None if it can't be imported"""
+    module, qualname = getattr(function, '__module__', None), getattr(function, '__qualname__', None)
+    if not module or module == '__main__' or not qualname or '<locals>' in qualname: return None
+    try: return (module, qualname) if _resolve(module, qualname) is function else None
+    except Exception: return None
+
+
+def _without_widget(function):
+    """Return a copy of a function decorated with build_ui without the widgets, so they aren't pickled with it"""
+    if not isinstance(function, types.FunctionType): return function
+    if '__widget__' not in function.__dict__ and '_ipython_display_' not in function.__dict__: return function
+    copy = types.FunctionType(function.__code__, function.__globals__, function.__name__, function.__defaults__,
+                              function.__closure__)
+    copy.__dict__.update({k: v for k, v in function.__dict__.items() if k not in ('__widget__', '_ipython_display_')})
+    copy.__kwdefaults__, copy.__qualname__, copy.__module__ = function.__kwdefaults__, function.__qualname__, function.__module__
+    copy.__doc__, copy.__annotations__ = function.__doc__, function.__annotations__
+    return copy
+
+
+_worker_queue = None  # Queue to the kernel, in worker processes
+
+
+def _init_worker(queue):
+    """Keep the queue used to send printed text back to the kernel, called as each worker process starts"""
+    global _worker_queue
+    _worker_queue = queue
+
+
+def _process_call(job, payload):
+    """Call the pickled function in a worker process, sending what it prints to the kernel"""
+    function, kwargs = pickle.loads(payload)
+    if isinstance(function, tuple): function = _resolve(*function)  # Sent by name
+    streams = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = (LineBuffer(lambda text, name=name: _worker_queue.put((job, name, text)), stream)
+                              for name, stream in zip(('stdout', 'stderr'), streams))
+    try: return function(**kwargs)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = streams
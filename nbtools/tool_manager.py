@@ -1,14 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import zlib
+from asyncio import iscoroutinefunction
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import count
 from IPython import get_ipython
 from IPython.display import display
 from ipywidgets import Output
-from threading import Timer, Thread
-from time import time
+from jupyter_core.paths import jupyter_data_dir
+from threading import Timer, RLock
+from time import time, perf_counter
+from uuid import uuid4
+from .comm_handler import CommHandler
+from .comm_sender import CommSender
+from .comm_stats import CommStats
+from .data_probe import DataProbe
 from .event_manager import EventManager
+from .registry_snapshot import RegistrySnapshot
+from .search_index import SearchIndex
+from .widget_cache import WidgetCache
 from .uioutput import UIOutput
 
 
+class ChangeLog(object):
+    """
+    Versioned log of changes to the tool, origin and data registries
+
+    Only the latest change to each registry entry is kept, so the log never grows larger than the registries
+    themselves (plus removals). A delta since any version at or above the floor can be computed from the log.
+    """
+    LIMIT = 100000  # Maximum number of entries before the oldest are discarded
+
+    def __init__(self):
+        self.version = 0                # The current version of the registries
+        self.floor = 0                  # The oldest version a delta can be computed from
+        self.entries = OrderedDict()    # (section, key) -> (version, removed), ordered oldest to newest
+
+    def record(self, section, key, removed=False):
+        """Record a change to the entry identified by section and key, return the new version"""
+        self.version += 1
+        self.entries.pop((section, key), None)              # Move the entry to the newest position
+        self.entries[(section, key)] = (self.version, removed)
+
+        # Discard the oldest entries if over the limit, deltas from before them are no longer possible
+        while len(self.entries) > ChangeLog.LIMIT:
+            _, (version, _) = self.entries.popitem(last=False)
+            self.floor = version
+        return self.version
+
+    def covers(self, version):
+        """Can a delta be computed from the provided version?"""
+        return version is not None and self.floor <= version <= self.version
+
+    def since(self, version):
+        """Return a list of (section, key, removed) tuples changed after the provided version, oldest first"""
+        changes = []
+        for (section, key), (v, removed) in reversed(self.entries.items()):
+            if v <= version: break
+            changes.append((section, key, removed))
+        changes.reverse()
+        return changes
+
+
+class ClientState(object):
+    """
+    State of a client connected to the kernel through an nbtools comm
+    """
+
+    def __init__(self, comm):
+        self.comm = comm            # The comm to communicate with the client
+        self.version = None         # The last registry version acknowledged by the client
+        self.encodings = []         # Payload encodings supported by the client
+        self.stubs = False          # Does the client list tool stubs, loading details on demand?
+
+    @property
+    def closed(self):
+        return getattr(self.comm, '_closed', False)
+
+
 class ToolManager(object):
     COMM_NAME = 'nbtools_comm'  # The name of the kernel <-> client comm
+    COMPRESSION_THRESHOLD = 256 * 1024  # Size in bytes above which updates are compressed, if the client supports it
+    REGISTRY_SECTIONS = ('tools', 'origins', 'data')
+    HANDLER_WORKERS = 4         # Size of the thread pool running comm handlers and callbacks
+    SNAPSHOT_DELAY = 1          # Seconds to wait before writing changes to the registry snapshot
+    SNAPSHOT_GRACE = 60         # Seconds restored snapshot entries wait to be registered before they are dropped
     _instance = None            # ToolManager singleton
 
     @staticmethod
@@ -19,55 +99,311 @@ class ToolManager(object):
 
     def __init__(self):
         self.tools = {}             # Initialize the tools map
-        self.callbacks = {}         # Initialize the map of function callbacks
-        self.comm = None            # The comm to communicate with the client
+        self.search_index = SearchIndex()  # Index of registered tools, used to answer searches
+        self.callbacks = {}         # Initialize the map of function callbacks, key -> CommHandler
+        self.handlers = {}          # Map of comm message func -> CommHandler
+        self.executor = None        # Thread pool running comm handlers and callbacks, lazily created
+        self.lock = RLock()         # Guards the registries against handlers running on other threads
+        self.clients = OrderedDict()  # Connected clients, comm id -> ClientState, oldest first
+        self.comm_stats = CommStats()  # Counters describing comm traffic
+        self.sender = CommSender(stats=self.comm_stats)  # Worker which sends messages to the clients in order
+        self.stats_timer = None     # Timer for periodically reporting stats, if enabled
         self.last_update = 0        # The last time the client was updated
         self.update_queued = False  # Waiting for an update?
-
-        # Create the nbtools comm target
-        def comm_target(comm, open_msg):
-            # Handle messages sent to the comm target
-            @comm.on_msg
-            def receive(msg):
-                data = msg['content']['data']
-                if data['func'] == 'request_update':  # Push an update to the client
-                    self.send_update()
-                elif data['func'] == 'origin_button':  # Make a callback, if the button key has been registered
-                    if 'payload' in data and 'name' in data['payload'] and data['payload']['name'] in self.callbacks:
-                        name = data['payload']['name']
-                        option = data['payload']['option'] if 'option' in data['payload'] else None
-                        self.callbacks[name](option)
-                else:
-                    print('ToolManager received unknown message')
-
-            # Keep a reference to the comm
-            self.comm = comm
+        self.changes = ChangeLog()  # Versioned log of registry changes
+        self.registry_id = uuid4().hex  # Identifies this kernel's registries, versions are only comparable within it
+        self.batch_depth = 0        # Number of nested batch() blocks currently open
+        self.batch_dirty = False    # Has a client update been deferred by the current batch?
+        self.batch_events = []      # Events deferred by the current batch, as (event, data) tuples
+        self.snapshot = None        # RegistrySnapshot the registries are saved to, if enabled
+        self.snapshot_version = 0   # The registry version last written to the snapshot
+        self.snapshot_queued = False  # Waiting to write to the snapshot?
+        self.stale = {}             # Entries restored from the snapshot and not yet confirmed, section -> key -> object
+
+        # Register the handlers for messages sent by the client
+        self.handlers['request_update'] = CommHandler(self._handle_request_update)
+        self.handlers['ack'] = CommHandler(self._handle_ack)
+        self.handlers['search'] = CommHandler(self._handle_search)
+        self.handlers['tool_details'] = CommHandler(self._handle_tool_details)
+        self.handlers['origin_button'] = CommHandler(self._handle_origin_button)
+
+        # Create the nbtools comm target, each client opens its own comm
+        def comm_target(comm, open_msg): self.add_client(comm)
 
         # Register the comm target
         get_ipython().kernel.comm_manager.register_target(ToolManager.COMM_NAME, comm_target)
 
-    def send_update(self):
+    @property
+    def comm(self):
+        """The comm of the most recently connected client, or None if no client is connected"""
+        clients = self._open_clients()
+        return clients[-1].comm if clients else None
+
+    def add_client(self, comm):
+        """Track a newly opened client comm and handle the messages sent through it"""
+        client = ClientState(comm)
+        self.clients[comm.comm_id] = client
+
+        # Handle messages sent to the comm target
+        @comm.on_msg
+        def receive(msg): self.receive(client, msg['content']['data'])
+
+        # Stop sending to the client once its comm closes
+        @comm.on_close
+        def close(msg): self.clients.pop(comm.comm_id, None)
+
+        return client
+
+    def _open_clients(self):
+        """Return the list of connected clients, dropping any whose comm has closed"""
+        for comm_id in [i for i, c in self.clients.items() if c.closed]: del self.clients[comm_id]
+        return list(self.clients.values())
+
+    def receive(self, client, data):
+        """Handle a message sent by a client, dispatching it to the handler registered for its func"""
+        func = data['func'] if 'func' in data else None
+        self.comm_stats.record_received(func)
+        if func not in self.handlers:
+            print('ToolManager received unknown message')
+            return
+
+        payload = data['payload'] if 'payload' in data else {}
+        self.handlers[func].dispatch((client, payload), lambda e: self.report_error(client, func, e), self._executor())
+
+    def _executor(self):
+        """Return the thread pool running comm handlers and callbacks, lazily creating it"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=ToolManager.HANDLER_WORKERS, thread_name_prefix='nbtools-handler')
+        return self.executor
+
+    def report_error(self, client, name, error):
+        """Log an error raised by a comm handler or callback and notify the client which made the request"""
+        logging.error(f'nbtools error in {name}', exc_info=error)
+        self.send_to(client, 'notification', {'message': f'Error in {name}: {error}', 'sender': 'nbtools'})
+
+    @classmethod
+    def register_comm_handler(cls, func, handler, mode='inline', max_concurrency=None):
+        """
+        Register a handler for comm messages sent by the client with the provided func, replacing any existing handler
+
+        :param func: the func of the messages to handle
+        :param handler: function called with the ClientState of the sender and the message payload
+        :param mode: 'inline' to run on the comm message handler, 'thread' to run on a thread pool, or 'async' if
+                     the handler is a coroutine function to run on the kernel's event loop
+        :param max_concurrency: maximum number of calls to run at once, None if unlimited
+        """
+        cls.instance().handlers[func] = CommHandler(handler, mode=mode, max_concurrency=max_concurrency)
+
+    def _handle_request_update(self, client, payload):
+        """Push an update to the client"""
+        self.receive_update_request(client, payload)
+
+    def _handle_ack(self, client, payload):
+        """Record the registry version the client has applied"""
+        version = payload['version'] if 'version' in payload else None
+        client.version = version if self.changes.covers(version) else None
+
+    def _handle_search(self, client, payload):
+        """Search the registered tools and return the ranked (origin, id) keys"""
+        self.send_to(client, 'search', {
+            'request': payload.get('request'),
+            'query': payload.get('query', ''),
+            'results': self.search_index.search(payload.get('query', ''), payload.get('limit'))
+        })
+
+    def _handle_tool_details(self, client, payload):
+        """Return the full descriptions of the requested tools"""
+        self.send_to(client, 'tool_details', {
+            'request': payload.get('request'),
+            'tools': [t.json_safe() for t in (self._entry('tools', (o, i)) or self.stale.get('tools', {}).get((o, i))
+                                              for o, i in payload.get('tools', [])) if t is not None]
+        })
+
+    def _handle_origin_button(self, client, payload):
+        """Make a callback, if the button key has been registered"""
+        if 'name' in payload and payload['name'] in self.callbacks:
+            name = payload['name']
+            option = payload['option'] if 'option' in payload else None
+            self.callbacks[name].dispatch((option,), lambda e: self.report_error(client, name, e), self._executor())
+
+    def receive_update_request(self, client, payload):
+        """
+        Respond to a client's request for an update. If the client sends the registry id and version it has
+        cached, reply that nothing has changed or send only the changes since. Otherwise, send everything.
+        """
+        client.encodings = payload.get('encodings', [])
+        client.stubs = payload.get('stubs', False)
+        version = payload.get('version') if payload.get('registry') == self.registry_id else None
+        client.version = version if self.changes.covers(version) else None
+
+        if client.version is not None and client.version == self.changes.version:
+            self.last_update = time()
+            self.send_to(client, 'update', {**self._header(), 'unchanged': True})
+        else: self.send_update(clients=[client])
+
+    def send_update(self, clients=None):
+        """
+        Send each client the registry changes since the version it last acknowledged, or everything if unknown
+        Clients at the same version with the same options share one serialized payload
+        """
         self.last_update = time()
-        self.send('update', {
+        started = perf_counter()
+        encoded = {}  # Serialized payloads, keyed by the client state they depend on
+        with self.lock:
+            for client in self._open_clients() if clients is None else clients:
+                since = client.version if self.changes.covers(client.version) else None
+                key = (since, client.stubs, 'zlib' in client.encodings)
+                if key not in encoded:
+                    payload = self._snapshot() if since is None else self._delta(since)
+                    encoded[key] = self._encode(payload, client)
+                self.send_to(client, 'update', *encoded[key])
+        self.comm_stats.record_update(perf_counter() - started)
+        self._queue_snapshot()
+
+    def request_update(self):
+        """Send the client an update, unless inside a batch, in which case it is sent when the batch ends"""
+        if self.batch_depth: self.batch_dirty = True
+        else: self.send_update()
+
+    def dispatch(self, event, data, key=None):
+        """Dispatch an event, unless inside a batch, in which case it is merged into a batch event"""
+        if self.batch_depth: self.batch_events.append((event, data, key))
+        else: EventManager.instance().dispatch(event, data, key=key)
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """
+        Context manager which defers client updates and registration events until the block exits.
+        A single update is then sent and the events for each name are merged into one '<name>_batch' event,
+        with the individual event data in its 'events' list. Callbacks subscribed to an event with a key still
+        receive the individual events dispatched with their key.
+
+        Example:
+            with ToolManager.batch():
+                for t in tools: ToolManager.register(t)
+        """
+        manager = cls.instance()
+        manager.batch_depth += 1
+        try: yield manager
+        finally:
+            manager.batch_depth -= 1
+            if not manager.batch_depth: manager._end_batch()
+
+    def _end_batch(self):
+        """Send the deferred update and dispatch the merged events"""
+        events, self.batch_events = self.batch_events, []
+        if self.batch_dirty:
+            self.batch_dirty = False
+            self.send_update()
+
+        # Route keyed events to the callbacks subscribed with their key
+        for event, data, key in events:
+            if key is not None: EventManager.instance().route(event, data, key)
+
+        # Merge events by name, preserving the order in which each name first occurred
+        merged = OrderedDict()
+        for event, data, _ in events: merged.setdefault(event, []).append(data)
+        for event, data_list in merged.items():
+            EventManager.instance().dispatch(f'{event}_batch', {'events': data_list})
+
+    def _header(self):
+        """Build the fields common to every update payload"""
+        header = {
             'import': 'nbtools' in get_ipython().user_global_ns,
-            'tools': list(map(lambda t: t.json_safe(), self._list())),
-            'origins': list(map(lambda o: o.json_safe(), DataManager.list_origins())),
-            'data': list(map(lambda d: d.json_safe(), DataManager.list())),
-        })
+            'registry': self.registry_id,
+            'version': self.changes.version,
+        }
+        if self.stale: header['stale'] = True  # Listing includes snapshot entries which may not be registered again
+        return header
+
+    def _snapshot(self):
+        """Build a payload containing the full state of the registries, sections list the registered objects"""
+        return {
+            **self._header(),
+            'tools': self._list() + self._stale('tools'),
+            'origins': list(DataManager.list_origins()) + self._stale('origins'),
+            'data': DataManager.list() + self._stale('data'),
+        }
 
-    def send(self, message_type, payload):
+    def _entry(self, section, key):
+        """Return the registered object identified by section and key, or None if not registered"""
+        if section == 'tools': return self.tools.get(key[0], {}).get(key[1])
+        elif section == 'origins': return DataManager.instance().origins.get(key)
+        else: return DataManager.instance().data_registry.get(key[0], {}).get(key[1])
+
+    def _listed(self, section, key):
+        """Return the registered object identified by section and key, or the restored snapshot entry if not registered"""
+        entry = self._entry(section, key)
+        return self.stale.get(section, {}).get(key) if entry is None else entry
+
+    def _stale(self, section):
+        """Return the restored snapshot entries in a section which have not been registered again"""
+        return [o for key, o in self.stale.get(section, {}).items() if self._entry(section, key) is None]
+
+    def _delta(self, since):
+        """Build a payload containing only the registry entries added, changed or removed after a version"""
+        payload = {
+            **self._header(),
+            'since': since,
+            'tools': [], 'origins': [], 'data': [],
+            'removed': {'tools': [], 'origins': [], 'data': []}
+        }
+        for section, key, removed in self.changes.since(since):
+            if removed: payload['removed'][section].append(key)
+            else: payload[section].append(self._listed(section, key))
+        return payload
+
+    def _encode(self, payload, client):
+        """
+        Serialize the registry sections of an update payload for a client, return the payload, any binary buffers and
+        the encoded size in bytes. Large payloads are sent as zlib-compressed JSON in a buffer if the client supports it
         """
-        Send a message to the comm on the client
+        sections = ToolManager.REGISTRY_SECTIONS
+        header = {k: v for k, v in payload.items() if k not in sections}
+        if client.stubs: header['stubs'] = True
+
+        # Stub listings only include the lightweight fields of each tool
+        def serialize(section, o): return o.json_stub() if client.stubs and section == 'tools' else o.json_safe()
+        def fragment(section, o): return o.stub_fragment() if client.stubs and section == 'tools' else o.json_fragment()
+
+        # The cached fragments give the size of the sections without serializing them again
+        fragments = {s: [fragment(s, o) for o in payload[s]] for s in sections}
+        size = sum(len(f) + 1 for s in sections for f in fragments[s]) + sum(len(s) + 6 for s in sections)
+        if 'zlib' in client.encodings and size > ToolManager.COMPRESSION_THRESHOLD:
+            body = '{' + ','.join(f'"{s}":[' + ','.join(fragments[s]) + ']' for s in sections) + '}'
+            header, buffers = {**header, 'encoding': 'zlib'}, [zlib.compress(body.encode('utf-8'))]
+            return header, buffers, len(json.dumps(header, default=str)) + len(buffers[0])
+
+        size += len(json.dumps(header, default=str))
+        return {**header, **{s: [serialize(s, o) for o in payload[s]] for s in sections}}, None, size
+
+    def send(self, message_type, payload, buffers=None):
+        """
+        Send a message to the comm on every connected client
 
         :param message_type:
         :param payload:
+        :param buffers: optional list of binary buffers to send with the message
         :return:
         """
-        # Protect against uninitialized comms
-        if self.comm is None: return
+        for client in self._open_clients(): self.send_to(client, message_type, payload, buffers)
+
+    def send_to(self, client, message_type, payload, buffers=None, size=None):
+        """
+        Send a message to the comm on a single client
 
-        # Make a call to the comm in its own thread so that it doesn't block cell execution
-        Thread(target=lambda: self.comm.send({ "func": message_type, "payload": payload })).start()
+        :param client: ClientState of the client
+        :param message_type:
+        :param payload:
+        :param buffers: optional list of binary buffers to send with the message
+        :param size: encoded size of the message in bytes, if already known
+        :return:
+        """
+        # Queue the message for the sender worker so that it doesn't block cell execution
+        # A newer update supersedes any update still waiting to be sent
+        self.sender.send(client.comm, { "func": message_type, "payload": payload }, buffers=buffers,
+                         coalesce=message_type == 'update', size=size)
 
     def _list(self):
         """
@@ -96,8 +432,147 @@ class ToolManager(object):
             wait = abs(self.last_update - time())
             timeout = Timer(3, postponed_update)
             self.update_queued = True
+            self.comm_stats.record_queued_update()
             timeout.start()
 
+    @classmethod
+    def enable_snapshot(cls, path=None, grace=SNAPSHOT_GRACE):
+        """
+        Save the registries to a SQLite snapshot as they change. Entries saved by a previous kernel are listed to the
+        client right away, marked as stale, until they are registered again. Those not registered again within the
+        grace period, or by the time confirm_snapshot() is called, are removed.
+
+        Each notebook needs its own snapshot, otherwise kernels restore, and then remove, each other's entries.
+
+        :param path: path to the snapshot file, defaults to a file for the kernel's notebook in nbtools/snapshots in
+                     the Jupyter data directory. The snapshot isn't enabled if the notebook isn't known.
+        :param grace: seconds to wait for restored entries to be registered again, None to wait for confirm_snapshot()
+        """
+        path = path or ToolManager._snapshot_path()
+        if path is None:
+            logging.warning('nbtools snapshot not enabled, the notebook is unknown so a snapshot path must be given')
+            return
+        manager = cls.instance()
+        manager.snapshot = RegistrySnapshot(path)
+
+        # Restore the entries saved by the previous kernel
+        restore = {
+            'tools': lambda d: NBTool(**d),
+            'origins': lambda d: NBOrigin(**d),
+            'data': lambda d: Data(**{k: v for k, v in d.items() if k != 'widget'}),
+        }
+        entries = manager.snapshot.load()
+        with manager.lock:
+            for section in ToolManager.REGISTRY_SECTIONS:
+                stale = manager.stale.setdefault(section, {})
+                for key, value in entries.get(section, []):
+                    if manager._entry(section, key) is None:
+                        stale[key] = restore[section](value)
+                        manager.changes.record(section, key)  # Clients already up to date receive it in a delta
+            manager.snapshot_version = 0  # Write everything registered so far
+
+        if grace is not None:
+            timer = Timer(grace, cls.confirm_snapshot)
+            timer.daemon = True
+            timer.start()
+        manager.request_update()
+
+    @staticmethod
+    def _snapshot_path():
+        """Return the default snapshot path for the kernel's notebook, or None if the server didn't name the notebook"""
+        session = os.environ.get('JPY_SESSION_NAME')  # Path of the notebook, set by Jupyter Server for its kernels
+        if not session: return None
+        name = hashlib.sha256(os.path.abspath(session).encode('utf-8')).hexdigest()
+        return os.path.join(jupyter_data_dir(), 'nbtools', 'snapshots', f'{name}.sqlite')
+
+    @classmethod
+    def confirm_snapshot(cls, origin=None):
+        """
+        Remove the restored snapshot entries which have not been registered again
+
+        :param origin: only remove the entries from this origin, once it has finished registering
+        """
+        manager = cls.instance()
+        with manager.lock:
+            for section, stale in manager.stale.items():
+                for key in [k for k in stale if origin is None or (k if section == 'origins' else k[0]) == origin]:
+                    del stale[key]
+                    if manager._entry(section, key) is None: manager.changes.record(section, key, removed=True)
+            if not any(manager.stale.values()): manager.stale = {}
+        manager.request_update()
+
+    def _queue_snapshot(self):
+        """Write the registry changes to the snapshot after a short delay, so bursts of changes are written once"""
+        if self.snapshot is None or self.snapshot_queued: return
+        self.snapshot_queued = True
+        timer = Timer(ToolManager.SNAPSHOT_DELAY, self.write_snapshot)
+        timer.daemon = True
+        timer.start()
+
+    def write_snapshot(self):
+        """Write the registry changes since the last write to the snapshot"""
+        if self.snapshot is None: return
+        self.snapshot_queued = False
+        with self.lock:
+            replace = not self.changes.covers(self.snapshot_version)  # Too old for a delta, write everything
+            if replace:
+                changes = [(section, key, o.json_fragment()) for section in ToolManager.REGISTRY_SECTIONS
+                           for key, o in self.stale.get(section, {}).items()]
+                changes += [('tools', (t.origin, t.id), t.json_fragment()) for t in self._list()]
+                changes += [('origins', o.name, o.json_fragment()) for o in DataManager.list_origins()]
+                changes += [('data', (d.origin, d.uri), d.json_fragment()) for d in DataManager.list()]
+            else:
+                changes = []
+                for section, key, removed in self.changes.since(self.snapshot_version):
+                    entry = None if removed else self._listed(section, key)
+                    changes.append((section, key, None if entry is None else entry.json_fragment()))
+            self.snapshot_version = self.changes.version
+        self.snapshot.write(changes, replace=replace)
+
+    @classmethod
+    def stats(cls):
+        """
+        Get statistics on the comm traffic since the last reset: update counts and serialization time, the number,
+        size in bytes and send time of messages by func, messages received by func and the largest payloads sent
+
+        :return: dict of statistics
+        """
+        manager = cls.instance()
+        return {
+            **manager.comm_stats.snapshot(),
+            'clients': len(manager._open_clients()),
+            'queue_depth': manager.sender.depth,
+            'coalesced': manager.sender.coalesced,
+            'version': manager.changes.version,
+        }
+
+    @classmethod
+    def reset_stats(cls):
+        """Reset the comm traffic statistics"""
+        cls.instance().comm_stats.reset()
+        cls.instance().sender.coalesced = 0
+
+    @classmethod
+    def periodic_stats(cls, interval=60):
+        """
+        Every interval seconds, log the comm traffic statistics and dispatch them in an nbtools.stats event
+        Pass an interval of None to stop
+        """
+        manager = cls.instance()
+        if manager.stats_timer: manager.stats_timer.cancel()
+        manager.stats_timer = None
+        if interval is None: return
+
+        def report():
+            stats = cls.stats()
+            logging.info(f'nbtools comm stats: {json.dumps(stats)}')
+            EventManager.instance().dispatch('nbtools.stats', stats)
+            cls.periodic_stats(interval)  # Schedule the next report
+
+        manager.stats_timer = Timer(interval, report)
+        manager.stats_timer.daemon = True
+        manager.stats_timer.start()
+
     @classmethod
     def list(cls):
         """
@@ -108,10 +583,20 @@ class ToolManager(object):
         # return [t for t in o.values() for o in cls.instance().tools.values()]
         return cls.instance()._list()
 
+    @classmethod
+    def search(cls, query, limit=None):
+        """
+        Search the registered tools by name, description, tags and origin
+
+        :return: list of matching tools, best matches first
+        """
+        tools = cls.instance().tools
+        return [tools[origin][id] for origin, id in cls.instance().search_index.search(query, limit)]
+
     @classmethod
     def register_all(cls, tool_list, **kwargs):
-        for tool in tool_list: cls.register(tool, skip_update=True, **kwargs)
-        cls.instance().send_update()  # Notify the client of the registration
+        with cls.batch():  # Notify the client of the registration once all tools are registered
+            for tool in tool_list: cls.register(tool, **kwargs)
 
     @classmethod
     def register(cls, tool_or_widget, skip_update=False, **kwargs):
@@ -119,41 +604,57 @@ class ToolManager(object):
         if isinstance(tool_or_widget, NBTool):
             tools = cls.instance().tools
             if tool_or_widget.origin and tool_or_widget.id:
-                # Lazily create the origin
-                if tool_or_widget.origin not in tools:
-                    tools[tool_or_widget.origin] = {}
-
-                # Register the tool
-                cls.instance().tools[tool_or_widget.origin][tool_or_widget.id] = tool_or_widget
+                with cls.instance().lock:
+                    # Lazily create the origin
+                    if tool_or_widget.origin not in tools:
+                        tools[tool_or_widget.origin] = {}
+
+                    # Register the tool
+                    cls.instance().tools[tool_or_widget.origin][tool_or_widget.id] = tool_or_widget
+                    cls.instance().changes.record('tools', (tool_or_widget.origin, tool_or_widget.id))
+                    cls.instance().search_index.add((tool_or_widget.origin, tool_or_widget.id), {
+                        'name': tool_or_widget.name,
+                        'description': tool_or_widget.description,
+                        'tags': tool_or_widget.tags,
+                        'origin': tool_or_widget.origin
+                    })
 
                 # Notify the client of the registration
-                if not skip_update: cls.instance().send_update()
+                if not skip_update: cls.instance().request_update()
 
                 # Dispatch the register event
-                EventManager.instance().dispatch('nbtools.register', {
+                cls.instance().dispatch('nbtools.register', {
                     'origin': tool_or_widget.origin,
                     'id': tool_or_widget.id,
                     **kwargs
-                })
+                }, key=(tool_or_widget.origin, tool_or_widget.id))
             else:
                 raise ValueError("register() must be passed a tool with an instantiated origin and id")
         else:
             raise ValueError("register() must be passed an NBTool or UIBuilder object")
 
     @classmethod
-    def register_callback(cls, key, callback):
-        """Register a callback that can be executed via the comm"""
+    def register_callback(cls, key, callback, mode=None, max_concurrency=1):
+        """
+        Register a callback that can be executed via the comm. By default callbacks run on a thread pool, or on the
+        kernel's event loop if the callback is a coroutine function, so that they don't block other comm messages.
+        See register_comm_handler() for the available modes.
+        """
+        if mode is None: mode = 'async' if iscoroutinefunction(callback) else 'thread'
         callbacks = cls.instance().callbacks
-        callbacks[key] = callback
+        callbacks[key] = CommHandler(callback, mode=mode, max_concurrency=max_concurrency)
 
     @classmethod
     def unregister(cls, origin, id):
         """Unregister the tool with the associated id"""
         if cls.exists(id, origin):
-            del cls.instance().tools[origin][id]
+            with cls.instance().lock:
+                del cls.instance().tools[origin][id]
+                cls.instance().changes.record('tools', (origin, id), removed=True)
+                cls.instance().search_index.remove((origin, id))
 
             # Notify the client of the un-registration
-            cls.instance().send_update()
+            cls.instance().request_update()
         else:
             print(f'Cannot find tool to unregister: {origin} | {id}')
 
@@ -173,14 +674,16 @@ class ToolManager(object):
         placeholder = UIOutput(name='Tool not loaded', error=f'Tool not loaded: {origin} | {id}')  # Placeholder widget
         output.append_display_data(placeholder)
 
-        # Callback to see if the placeholder needs replaced after a new widget is registered
+        # Callback to replace the placeholder once the tool is registered, including in a batch registration
         def check_registration_callback(data):
-            if 'origin' in data and 'id' in data and data['origin'] == origin and data['id'] == id:
-                placeholder.close()
-                with output: display(tool(**data))
-
-        # Register the callback with the event manager
-        EventManager.instance().register("nbtools.register", check_registration_callback)
+            placeholder.close()
+            with output: display(tool(**data))
+
+        # Register the callback with the event manager for this tool only, so that it is called at most once.
+        # It is unsubscribed once the output is closed and collected.
+        output._nbtools_callbacks = (check_registration_callback,)
+        EventManager.instance().register("nbtools.register", check_registration_callback, once=True, weak=True,
+                                         key=(origin, id))
         return output
 
     @classmethod
@@ -194,7 +697,38 @@ class ToolManager(object):
         else: return False
 
 
-class NBTool:
+class CachedJSON(object):
+    """
+    Base class for registry objects, caches the object's JSON-safe form until one of its public attributes is set
+    Subclasses must define _json_safe(), returning the dict describing the object, which json_safe() caches; call
+    invalidate() after mutating an attribute in place. Not an abc.ABC, as widgets such as UIBuilder subclass NBTool.
+    """
+    _cache_keys = ('_json_cache', '_json_fragment')  # Attributes holding cached serialized forms
+
+    def __setattr__(self, key, value):
+        if not key.startswith('_'): self.invalidate()
+        super(CachedJSON, self).__setattr__(key, value)
+
+    def invalidate(self):
+        """Discard the cached serialized forms"""
+        for key in self._cache_keys: self.__dict__.pop(key, None)
+
+    def _cached(self, key, build):
+        """Return the cached value for the key, building it if not cached"""
+        value = self.__dict__.get(key)
+        if value is None: value = self.__dict__[key] = build()
+        return value
+
+    def json_safe(self):
+        """Return a JSON-safe dict describing the object, this dict is shared and should not be modified"""
+        return self._cached('_json_cache', self._json_safe)
+
+    def json_fragment(self):
+        """Return the object's JSON-safe form encoded as a JSON string"""
+        return self._cached('_json_fragment', lambda: json.dumps(self.json_safe()))
+
+
+class NBTool(CachedJSON):
     """
     Tool class, used to register new tools with the manager
     """
@@ -205,12 +739,22 @@ class NBTool:
     tags = None
     version = None
     load = lambda self, **kwargs: self.__class__(**kwargs)
+    STUB_FIELDS = ('origin', 'id', 'name', 'version')  # Fields included in stub listings
+    _cache_keys = CachedJSON._cache_keys + ('_json_stub', '_json_stub_fragment')
 
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-    def json_safe(self):
+    def json_stub(self):
+        """Return the lightweight fields of the tool's JSON-safe form, omitting the description and tags"""
+        return self._cached('_json_stub', lambda: {k: self.json_safe().get(k) for k in NBTool.STUB_FIELDS})
+
+    def stub_fragment(self):
+        """Return the tool's stub encoded as a JSON string"""
+        return self._cached('_json_stub_fragment', lambda: json.dumps(self.json_stub()))
+
+    def _json_safe(self):
         return {
             'origin': self.origin,
             'id': self.id,
@@ -228,7 +772,7 @@ def tool(id, origin, **kwargs):
         except TypeError: return nbtool.load()
 
 
-class NBOrigin:
+class NBOrigin(CachedJSON):
     """
     Origin class, used to register new origins with the manager
     Otherwise origins are lazily created with new tools
@@ -243,7 +787,7 @@ class NBOrigin:
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-    def json_safe(self):
+    def _json_safe(self):
         buttons = []
         if hasattr(self, 'buttons'):
             for b in self.buttons:
@@ -263,12 +807,24 @@ class NBOrigin:
 
 class DataManager(object):
     _instance = None                # DataManager singleton
+    INDEXED = ('origin', 'kind', 'group')  # Data attributes with a secondary index
+    SWEEP_INTERVAL = 60                     # Maximum seconds between eviction sweeps when a TTL is set
 
     def __init__(self):
         self.data_registry = {}     # Initialize the data map
         self.origins = {}           # Initialize the origin map
-        self.group_widgets = {}     # Initialize widgets for groups
-        self.data_widgets = {}      # Initialize widgets for data
+        self.group_widgets = WidgetCache()  # Widgets for groups, keyed by (origin, group)
+        self.data_widgets = WidgetCache()   # Widgets for data, keyed by (origin, uri)
+        self.indexes = {field: {} for field in DataManager.INDEXED}  # field -> value -> {(origin, uri): data}
+        self.positions = {}         # origin and (origin, uri) -> sequence number, to sort index lookups in registry order
+        self.sequence = count()     # Source of positions
+        self.recent = OrderedDict() # (origin, uri) -> time last used, least recently used first
+        self.max_per_origin = None  # Maximum data registered to each origin, None if unlimited
+        self.max_total = None       # Maximum data registered in total, None if unlimited
+        self.ttl = None             # Seconds unused data is kept, None if forever
+        self.pinned = set()         # Origins whose data is never evicted
+        self.sweep_timer = None     # Timer for the next TTL sweep
+        self.probe = None           # DataProbe reading the metadata of registered local files, if enabled
 
     @staticmethod
     def instance():
@@ -314,30 +870,199 @@ class DataManager(object):
 
         :return: filtered list of data
         """
-        def has_attributes(tool, kwargs):
-            for kw in kwargs:
-                # Special case for kinds list
-                if kw == 'kinds':
-                    if tool.kind not in kwargs['kinds']: return False
-                    else: continue
+        # Look up indexed attributes, the special case kinds list is an alias for the kind index
+        if 'kinds' in kwargs: kwargs['kind'] = kwargs.pop('kinds')
+        elif 'kind' in kwargs: kwargs['kind'] = [kwargs['kind']]
+        if 'origin' in kwargs: kwargs['origin'] = [kwargs['origin']]
+        if 'group' in kwargs: kwargs['group'] = [kwargs['group']]
+        return self._query(**kwargs)
 
-                if not hasattr(tool, kw): return False
-                if getattr(tool, kw) != kwargs[kw]: return False
-            return True
+    @classmethod
+    def query(cls, origins=None, kinds=None, groups=None, **attributes):
+        """
+        Get the registered data matching any of the listed origins, any of the listed kinds and any of the listed
+        groups, as well as any other attributes provided. Origins, kinds and groups are looked up in indexes, so the
+        time taken is proportional to the number of matches rather than the size of the registry.
 
-        return [t for t in self._list() if has_attributes(t, kwargs)]
+        :return: list of data
+        """
+        return cls.instance()._query(origin=origins, kind=kinds, group=groups, **attributes)
+
+    def _query(self, **kwargs):
+        """Look up data by indexed attributes, then filter the candidates by any other attributes"""
+        # Gather the matches from each constrained index, a list of values matches any of them
+        candidates = []
+        for field in DataManager.INDEXED:
+            values = kwargs.pop(field, None)
+            if values is None: continue
+            index = self.indexes[field]
+            matches = {}
+            for value in values: matches.update(index.get(value, {}))
+            candidates.append(matches)
+
+        # Intersect the matches, starting with the smallest
+        if candidates:
+            candidates.sort(key=len)
+            results = [d for key, d in candidates[0].items() if all(key in c for c in candidates[1:])]
+            results.sort(key=lambda d: (self.positions[d.origin], self.positions[(d.origin, d.uri)]))  # Registry order
+        else: results = self._list()
+
+        # Filter by the attributes which aren't indexed
+        return [d for d in results if all(hasattr(d, kw) and getattr(d, kw) == v for kw, v in kwargs.items())]
+
+    def _index(self, data):
+        """Add the data to the secondary indexes"""
+        for field in DataManager.INDEXED:
+            self.indexes[field].setdefault(getattr(data, field), {})[(data.origin, data.uri)] = data
+
+    def _unindex(self, data):
+        """Remove the data from the secondary indexes"""
+        for field in DataManager.INDEXED:
+            index = self.indexes[field]
+            value = getattr(data, field)
+            if value in index:
+                index[value].pop((data.origin, data.uri), None)
+                if not index[value]: del index[value]
 
     def get(self, origin, uri):
         """Return data object matching origin and uri, return None if not found"""
-        for d in self.list():
-            if d.origin == origin and d.uri == uri:
-                return d
-        return None
+        data = self.data_registry.get(origin, {}).get(uri)
+        if data is not None: self._touch(origin, uri)
+        return data
+
+    @classmethod
+    def enable_probing(cls, algorithm=None, workers=2):
+        """
+        Read the size and modification time of local files as they are registered, on a background thread pool.
+        The results are set as the size, modified and checksum attributes of the Data object, and dispatched as an
+        nbtools.data_probe event. Data already registered is probed right away.
+
+        :param algorithm: name of the hashlib algorithm used to checksum files, such as 'sha256', None to skip hashing
+        :param workers: number of files probed at once
+        """
+        cls.disable_probing()
+        cls.instance().probe = DataProbe(algorithm=algorithm, workers=workers)
+        for data in cls.list(): cls.instance().probe.submit(data)
+
+    @classmethod
+    def disable_probing(cls):
+        """Stop reading the metadata of registered files"""
+        if cls.instance().probe: cls.instance().probe.shutdown()
+        cls.instance().probe = None
+
+    @classmethod
+    def set_limits(cls, max_per_origin=None, max_total=None, ttl=None, pinned=None):
+        """
+        Bound the size of the data registry, for long-running kernels. When a limit is exceeded the least recently
+        registered or used data is evicted, along with its widget. Data from pinned origins is never evicted, and
+        doesn't count towards the limits.
+
+        :param max_per_origin: maximum data registered to each unpinned origin, None if unlimited
+        :param max_total: maximum data registered in total to unpinned origins, None if unlimited
+        :param ttl: seconds data is kept after it was last used, None if forever
+        :param pinned: list of origins whose data is never evicted
+        """
+        manager = cls.instance()
+        manager.max_per_origin = max_per_origin
+        manager.max_total = max_total
+        manager.ttl = ttl
+        if pinned is not None: manager.pinned = set(pinned)
+        manager._schedule_sweep()
+        cls.evict()
+
+    @classmethod
+    def pin(cls, origin):
+        """Never evict data from the origin"""
+        cls.instance().pinned.add(origin)
+
+    @classmethod
+    def unpin(cls, origin):
+        """Allow data from the origin to be evicted"""
+        cls.instance().pinned.discard(origin)
+
+    @classmethod
+    def evict(cls):
+        """
+        Evict data exceeding the limits, notifying the client once for the whole sweep
+
+        :return: number of data evicted
+        """
+        with ToolManager.instance().lock: evicted = cls.instance()._evict()
+        if evicted: ToolManager.instance().request_update()
+        return evicted
+
+    def _touch(self, origin, uri):
+        """Mark the data as most recently used"""
+        key = (origin, uri)
+        with ToolManager.instance().lock:  # The sweep thread iterates over the LRU order
+            self.recent[key] = time()
+            self.recent.move_to_end(key)
+
+    def _evict(self):
+        """Evict data exceeding the limits, least recently used first, return the number of data evicted"""
+        if self.max_per_origin is None and self.max_total is None and self.ttl is None: return 0
+
+        # Count how many data must be evicted from each unpinned origin and in total
+        over_origin = {origin: len(uris) - self.max_per_origin for origin, uris in self.data_registry.items()
+                       if self.max_per_origin is not None and len(uris) > self.max_per_origin and origin not in self.pinned}
+        pinned = sum(len(self.data_registry.get(origin, {})) for origin in self.pinned)
+        over_total = len(self.recent) - pinned - self.max_total if self.max_total is not None else 0
+        expired = time() - self.ttl if self.ttl is not None else None
+
+        # Select the data to evict, stopping at the first recent data once the limits are met
+        evict = []
+        for (origin, uri), used in self.recent.items():
+            stale = expired is not None and used < expired
+            if not stale and over_total <= 0 and not any(n > 0 for n in over_origin.values()): break
+            if origin in self.pinned: continue
+            if stale or over_total > 0 or over_origin.get(origin, 0) > 0:
+                evict.append((origin, uri))
+                over_total -= 1
+                if origin in over_origin: over_origin[origin] -= 1
+
+        self._remove(evict)
+        return len(evict)
+
+    def _remove(self, keys):
+        """Remove the data with the (origin, uri) keys along with the widgets which reference it"""
+        for origin, uri in keys:
+            data = self.data_registry[origin].pop(uri)
+            if not self.data_registry[origin]:  # This was the last data from its origin
+                del self.data_registry[origin]
+                self.positions.pop(origin, None)
+            self._unindex(data)
+            self.recent.pop((origin, uri), None)
+            self.positions.pop((origin, uri), None)
+            self.data_widgets.pop((origin, uri))
+            group = self.indexes['group'].get(data.group, {})
+            if not any(key[0] == origin for key in group):  # This was the last data in its group
+                self.group_widgets.pop((origin, data.group))
+            ToolManager.instance().changes.record('data', (origin, uri), removed=True)
+
+    def _schedule_sweep(self):
+        """Periodically evict expired data while a TTL is set"""
+        if self.sweep_timer: self.sweep_timer.cancel()
+        self.sweep_timer = None
+        if self.ttl is None: return
+
+        def sweep():
+            if self.ttl is None: return  # The TTL was removed after the sweep started
+            try: DataManager.evict()
+            finally: self._schedule_sweep()  # Keep sweeping even if an eviction fails
+
+        self.sweep_timer = Timer(min(max(self.ttl, 1), DataManager.SWEEP_INTERVAL), sweep)
+        self.sweep_timer.daemon = True
+        self.sweep_timer.start()
+
+    @classmethod
+    def batch(cls):
+        """Context manager which defers client updates and data events until the block exits, see ToolManager.batch()"""
+        return ToolManager.batch()
 
     @classmethod
     def register_all(cls, data_list):
-        for data in data_list: cls.register(data, skip_update=True)
-        ToolManager.instance().send_update()  # Notify the client of the registration
+        with cls.batch():  # Notify the client of the registration once all data is registered
+            for data in data_list: cls.register(data)
 
     @classmethod
     def register(cls, data, skip_update=False):
@@ -345,22 +1070,36 @@ class DataManager(object):
         if isinstance(data, Data):
             data_registry = cls.instance().data_registry
             if data.origin and data.uri:
-                # Lazily create the origin
-                if data.origin not in data_registry:
-                    data_registry[data.origin] = {}
-
-                # Register the tool
-                cls.instance().data_registry[data.origin][data.uri] = data
+                with ToolManager.instance().lock:
+                    # Lazily create the origin
+                    if data.origin not in data_registry:
+                        data_registry[data.origin] = {}
+                        cls.instance().positions[data.origin] = next(cls.instance().sequence)
+
+                    # Register the data, replacing any previously registered at the same uri
+                    replaced = data_registry[data.origin].get(data.uri)
+                    if replaced is not None: cls.instance()._unindex(replaced)
+                    else: cls.instance().positions[(data.origin, data.uri)] = next(cls.instance().sequence)
+                    data_registry[data.origin][data.uri] = data
+                    cls.instance()._index(data)
+                    cls.instance()._touch(data.origin, data.uri)
+                    ToolManager.instance().changes.record('data', (data.origin, data.uri))
+                    cls.instance()._evict()  # Make room, the update below includes any evictions
+                    registered = data_registry.get(data.origin, {}).get(data.uri) is data
 
                 # Notify the client of the registration
-                if not skip_update: ToolManager.instance().send_update()
+                if not skip_update: ToolManager.instance().request_update()
+                if not registered: return  # Evicted right away, as the limits leave no room for it
+
+                # Read the file's metadata in the background
+                if cls.instance().probe: cls.instance().probe.submit(data)
 
                 # Dispatch the register event
-                EventManager.instance().dispatch('nbtools.data_register', {
+                ToolManager.instance().dispatch('nbtools.data_register', {
                     'origin': data.origin,
                     'group': data.group,
                     'id': data.uri
-                })
+                }, key=(data.origin, data.uri))
             else:
                 raise ValueError(f"register() must be passed a data object with an instantiated origin ({data.origin}) and uri ({data.uri})")
         else:
@@ -370,10 +1109,14 @@ class DataManager(object):
     def unregister(cls, origin, uri):
         """Unregister the data with the associated id"""
         if cls.exists(uri, origin):
-            del cls.instance().data_registry[origin][uri]
+            with ToolManager.instance().lock:
+                cls.instance()._unindex(cls.instance().data_registry[origin].pop(uri))
+                cls.instance().recent.pop((origin, uri), None)
+                cls.instance().positions.pop((origin, uri), None)
+                ToolManager.instance().changes.record('data', (origin, uri), removed=True)
 
             # Notify the client of the un-registration
-            ToolManager.instance().send_update()
+            ToolManager.instance().request_update()
         else:
             print(f'Cannot find data to unregister: {origin} | {uri}')
 
@@ -381,13 +1124,48 @@ class DataManager(object):
     def unregister_all(cls, origin, skip_update=False):
         """Unregister all data with the associated origin"""
         if cls.origin_exists(origin):
-            del cls.instance().data_registry[origin]
+            with ToolManager.instance().lock:
+                for uri, data in cls.instance().data_registry[origin].items():
+                    cls.instance()._unindex(data)
+                    cls.instance().recent.pop((origin, uri), None)
+                    cls.instance().positions.pop((origin, uri), None)
+                    ToolManager.instance().changes.record('data', (origin, uri), removed=True)
+                del cls.instance().data_registry[origin]
+                cls.instance().positions.pop(origin, None)
 
             # Notify the client of the un-registration
-            if not skip_update: ToolManager.instance().send_update()
+            if not skip_update: ToolManager.instance().request_update()
         else:
             print(f'Cannot find origin to unregister: {origin}')
 
+    @classmethod
+    def unregister_where(cls, origin=None, group=None, kind=None, uri_prefix=None, predicate=None, skip_update=False):
+        """
+        Unregister all data matching every criteria provided, along with its widgets, then notify the client once
+
+        :param origin: unregister data with this origin
+        :param group: unregister data in this group
+        :param kind: unregister data of this kind
+        :param uri_prefix: unregister data whose uri starts with this prefix
+        :param predicate: unregister data for which this function, passed the Data object, returns True
+        :return: number of data unregistered
+        """
+        if all(c is None for c in (origin, group, kind, uri_prefix, predicate)):
+            raise ValueError('unregister_where() must be passed at least one criteria, use unregister_all() to remove an origin')
+        manager = cls.instance()
+        with ToolManager.instance().lock:
+            # Look up candidates in the indexes, then apply the remaining criteria
+            matches = manager._query(origin=None if origin is None else [origin],
+                                     group=None if group is None else [group],
+                                     kind=None if kind is None else [kind])
+            keys = [(d.origin, d.uri) for d in matches
+                    if (uri_prefix is None or str(d.uri).startswith(uri_prefix)) and (predicate is None or predicate(d))]
+            manager._remove(keys)
+
+        # Notify the client of the un-registration
+        if keys and not skip_update: ToolManager.instance().request_update()
+        return len(keys)
+
     @classmethod
     def origin_exists(cls, origin):
         """Check if the origin exists in the data registiry"""
@@ -398,19 +1176,16 @@ class DataManager(object):
     @classmethod
     def exists(cls, uri, origin):
         """Check if a data object for the provided uri and origin exists"""
-        data_registry = cls.instance().data_registry
-        if origin in data_registry:
-            if uri in data_registry[origin]:
-                return True
-            else: return False
-        else: return False
+        return uri in cls.instance().data_registry.get(origin, {})
 
     @classmethod
     def register_origin(cls, origin, skip_update=False):
         origins = cls.instance().origins
 
         # Register the origin
-        cls.instance().origins[origin.name] = origin
+        with ToolManager.instance().lock:
+            cls.instance().origins[origin.name] = origin
+            ToolManager.instance().changes.record('origins', origin.name)
 
         # Register any button callbacks with the ToolManager
         if isinstance(origin.buttons, list):
@@ -419,7 +1194,7 @@ class DataManager(object):
                     ToolManager.instance().register_callback(button['name'], button['callback'])
 
         # Notify the client of the registration
-        if not skip_update: ToolManager.instance().send_update()
+        if not skip_update: ToolManager.instance().request_update()
 
     @classmethod
     def list_origins(cls):
@@ -433,33 +1208,37 @@ class DataManager(object):
 
     @classmethod
     def group_widget(cls, origin, group, widget=None):
-        # Lazily add origin
-        if origin not in cls.instance().group_widgets: cls.instance().group_widgets[origin] = {}
-
-        # Set widget if present
+        # Set widget if present, either a widget or a callable which builds it
         if widget:
-            cls.instance().group_widgets[origin][group] = widget
+            cls.instance().group_widgets.set((origin, group), widget)
             return
 
-        # Return the widget
-        if group not in cls.instance().group_widgets[origin]: return None
-        else: return cls.instance().group_widgets[origin][group]() \
-            if callable(cls.instance().group_widgets[origin][group]) else cls.instance().group_widgets[origin][group]
+        # Return the widget, built once and reused until it is closed
+        return cls.instance().group_widgets.get((origin, group))
 
     @classmethod
     def data_widget(cls, origin, uri, widget=None):
-        # Lazily add origin
-        if origin not in cls.instance().data_widgets: cls.instance().data_widgets[origin] = {}
-
-        # Set widget if present
+        # Set widget if present, either a widget or a callable which builds it
         if widget:
-            cls.instance().data_widgets[origin][uri] = widget
+            cls.instance().data_widgets.set((origin, uri), widget)
+            if cls.exists(uri, origin):  # The data's serialized form includes whether it has a widget
+                cls.instance().data_registry[origin][uri].invalidate()
+                ToolManager.instance().changes.record('data', (origin, uri))
             return
 
-        # Return the widget
-        if uri not in cls.instance().data_widgets[origin]: return None
-        else: return cls.instance().data_widgets[origin][uri]() \
-            if callable(cls.instance().data_widgets[origin][uri]) else cls.instance().data_widgets[origin][uri]
+        # Return the widget, built once and reused until it is closed
+        if (origin, uri) not in cls.instance().data_widgets: return None
+        if cls.exists(uri, origin): cls.instance()._touch(origin, uri)
+        return cls.instance().data_widgets.get((origin, uri))
+
+    @classmethod
+    def widget_stats(cls):
+        """
+        Get the hit and miss counts of the group and data widget caches
+
+        :return: dict of statistics for 'groups' and 'data'
+        """
+        return {'groups': cls.instance().group_widgets.stats(), 'data': cls.instance().data_widgets.stats()}
 
     @classmethod
     def data(cls, origin='Notebook', group=None, uris=None, uri=None):
@@ -492,22 +1271,21 @@ class DataManager(object):
         # Callback to see if the placeholder needs replaced after a new widget is registered
         def check_refresh_callback(data):
             if 'group' in kwargs:
-                group_widget = cls.instance().group_widget(origin=kwargs['origin'], group=kwargs['group'])
-                if group_widget:
-                    placeholder.close()
-                    with output: display(group_widget)
+                widget = cls.instance().group_widget(origin=kwargs['origin'], group=kwargs['group'])
             else:
-                data_widget = cls.instance().data_widget(origin=kwargs['origin'], uri=kwargs['files'][0])
-                if data_widget:
-                    placeholder.close()
-                    with output: display(data_widget)
+                widget = cls.instance().data_widget(origin=kwargs['origin'], uri=kwargs['files'][0])
+            if widget:
+                subscription.unsubscribe()  # Only replace the placeholder once
+                placeholder.close()
+                with output: display(widget)
 
-        # Register the callback with the event manager
-        EventManager.instance().register("nbtools.refresh_data", check_refresh_callback)
+        # Register the callback with the event manager, it is unsubscribed once the output is closed and collected
+        output._nbtools_callbacks = (check_refresh_callback,)
+        subscription = EventManager.instance().register("nbtools.refresh_data", check_refresh_callback, weak=True)
         return output
 
 
-class Data:
+class Data(CachedJSON):
     """
     Data class, used to register new data with the manager
     """
@@ -517,13 +1295,25 @@ class Data:
     label = None
     kind = None
     icon = None
+    size = None         # Size in bytes of a local file, set by DataManager.enable_probing()
+    modified = None     # Modification timestamp of a local file, set by DataManager.enable_probing()
+    checksum = None     # Checksum of a local file, set by DataManager.enable_probing()
     load = lambda self, **kwargs: self.__class__(**kwargs)
 
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-    def json_safe(self):
+    def __setattr__(self, key, value):
+        # Keep the DataManager's indexes current when the kind or group of registered data changes
+        if key in ('kind', 'group') and DataManager.instance().data_registry.get(self.origin, {}).get(self.uri) is self:
+            with ToolManager.instance().lock:
+                DataManager.instance()._unindex(self)
+                super(Data, self).__setattr__(key, value)
+                DataManager.instance()._index(self)
+        else: super(Data, self).__setattr__(key, value)
+
+    def _json_safe(self):
         return {
             'origin': self.origin,
             'group': self.group,
@@ -531,8 +1321,7 @@ class Data:
             'label': self.label,
             'kind': self.kind,
             'icon': self.icon,
-            'widget': self.origin in DataManager.instance().data_widgets and
-                      self.uri in DataManager.instance().data_widgets[self.origin]
+            'widget': (self.origin, self.uri) in DataManager.instance().data_widgets
         }
 
 
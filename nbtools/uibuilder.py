@@ -179,6 +179,7 @@ class UIBuilderBase(BaseWidget):
     _parent = None
     upload_callback = None
     license_callback = None
+    execution = 'inline'  # 'inline', or 'thread' or 'process' to run in the background
 
     def __init__(self, function_or_method, **kwargs):
         # Apply defaults based on function docstring/annotations
@@ -0,0 +1,159 @@
+import builtins
+import hashlib
+import json
+import logging
+import os
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+
+class URLCache(object):
+    """
+    Disk cache of files downloaded from URLs
+
+    Downloads are streamed to disk in chunks. A cached copy is revalidated with the server using its ETag or
+    Last-Modified date before it is used, and only downloaded again if it changed. Concurrent requests for the same
+    URL share one download. When the cache grows over its size limit the least recently used copies are removed.
+    In offline mode cached copies are used without contacting the server.
+    """
+    MAX_SIZE = 5 * 1024 ** 3    # Default maximum size of the cache in bytes
+    CHUNK_SIZE = 1024 * 1024    # Bytes written to disk at a time when downloading
+    TIMEOUT = 60                # Seconds to wait for the server to respond
+
+    def __init__(self, directory, max_size=MAX_SIZE, offline=False):
+        self.directory = directory  # Directory holding the cached files and their metadata
+        self.max_size = max_size    # Maximum size of the cache in bytes
+        self.offline = offline      # Use cached copies without contacting the server?
+        self.entries = OrderedDict()  # key -> metadata dict, least recently used first
+        self.size = 0               # Total size of the cached files in bytes
+        self.fetching = {}          # key -> Future of the download or revalidation in progress
+        self.lock = Lock()          # Guards the entries, size and fetches in progress
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Read the metadata of the files already in the cache"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'): continue
+            try:
+                with builtins.open(os.path.join(self.directory, name)) as f: entries.append(json.load(f))
+            except (OSError, ValueError): continue
+        for entry in sorted(entries, key=lambda e: e['accessed']):
+            if os.path.exists(self._path(entry['key'])):
+                self.entries[entry['key']] = entry
+                self.size += entry['size']
+
+    def _path(self, key, suffix=''):
+        return os.path.join(self.directory, key + suffix)
+
+    def open(self, url):
+        """Return a binary file object reading the content of the URL from the cache, fetching it if necessary"""
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        while True:
+            # Wait for any fetch of the same URL already in progress, otherwise start one
+            with self.lock:
+                future = self.fetching.get(key)
+                owner = future is None
+                if owner: future = self.fetching[key] = Future()
+            if owner:
+                try: future.set_result(self._fetch(url, key))
+                except BaseException as e: future.set_exception(e)
+                finally:
+                    with self.lock: del self.fetching[key]
+            path = future.result()
+
+            # Open the copy unless another download's eviction removed it since, in which case fetch it again
+            with self.lock:
+                if key in self.entries: return builtins.open(path, 'rb')
+
+    def _fetch(self, url, key):
+        """Make sure the cached copy of the URL is current, return the path to it"""
+        with self.lock: entry = self.entries.get(key)
+        if entry is not None and self.offline:
+            self._touch(key)
+            return self._path(key)
+        if self.offline: raise urllib.error.URLError(f'{url} is not cached and nbtools is offline')
+
+        # Ask the server to send the content only if it has changed
+        request = urllib.request.Request(url)
+        if entry and entry.get('etag'): request.add_header('If-None-Match', entry['etag'])
+        if entry and entry.get('last_modified'): request.add_header('If-Modified-Since', entry['last_modified'])
+        try: response = urllib.request.urlopen(request, timeout=URLCache.TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or entry is None: raise
+            self._touch(key)  # Not modified
+            return self._path(key)
+        except urllib.error.URLError as e:
+            if entry is None: raise
+            logging.warning(f'nbtools unable to revalidate {url}, using the cached copy: {e}')
+            self._touch(key)
+            return self._path(key)
+
+        with response: return self._download(url, key, response)
+
+    def _download(self, url, key, response):
+        """Stream the response to the cache, replacing any previous copy"""
+        partial = self._path(key, f'.{uuid4().hex}.part')
+        size = 0
+        try:
+            with builtins.open(partial, 'wb') as f:
+                for chunk in iter(lambda: response.read(URLCache.CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(partial, self._path(key))
+        except BaseException:
+            if os.path.exists(partial): os.remove(partial)
+            raise
+
+        entry = {'key': key, 'url': url, 'size': size, 'accessed': time(),
+                 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous: self.size -= previous['size']
+            self.entries[key] = entry
+            self.size += size
+        self._write_metadata(entry)
+        self._evict(keep=key)
+        return self._path(key)
+
+    def _touch(self, key):
+        """Mark the cached copy as most recently used"""
+        with self.lock:
+            entry = self.entries[key]
+            entry['accessed'] = time()
+            self.entries.move_to_end(key)
+        self._write_metadata(entry)
+
+    def _write_metadata(self, entry):
+        try:
+            with builtins.open(self._path(entry['key'], '.json'), 'w') as f: json.dump(entry, f)
+        except OSError as e: logging.warning(f'nbtools unable to write URL cache metadata: {e}')
+
+    def _evict(self, keep=None):
+        """Remove the least recently used copies until the cache is within its size limit"""
+        with self.lock:
+            evict = []
+            for key, entry in self.entries.items():
+                if self.size <= self.max_size: break
+                if key == keep or key in self.fetching: continue
+                evict.append(key)
+                self.size -= entry['size']
+            for key in evict: del self.entries[key]
+
+            # Remove the files while holding the lock, so open() doesn't return a copy which is being removed
+            for key in evict:
+                for path in (self._path(key), self._path(key, '.json')):
+                    try: os.remove(path)
+                    except OSError: pass
+
+    def clear(self):
+        """Remove every cached copy"""
+        max_size, self.max_size = self.max_size, -1
+        self._evict()
+        self.max_size = max_size
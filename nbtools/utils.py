@@ -1,8 +1,19 @@
+import atexit
 import builtins
+import logging
+import mmap
+import os
 import re
 import urllib
 import requests
 import threading
+from collections import OrderedDict
+from .url_cache import URLCache
+
+
+_url_cache = None       # Disk cache used by open() for URLs, lazily created
+_url_cache_enabled = True
+CHUNK_SIZE = 1024 * 1024  # Default size in bytes of the chunks read in the 'chunks' mode of open()
 
 
 def is_url(path_or_url):
@@ -16,17 +27,84 @@ def is_url(path_or_url):
     return re.match(matches_url, path_or_url)
 
 
-def open(path_or_url):
+def open(path_or_url, mode=None, cache=True, chunk_size=CHUNK_SIZE):
     """
     Wrapper for opening an IO object to a local file or URL
 
+    By default local files are opened in text mode and URLs as a binary stream. Other modes avoid decoding and
+    copying large inputs:
+        'binary': a binary file object
+        'chunks': an iterator of memoryview chunks read into a reused buffer, copy a chunk to keep it past the next
+        'mmap': a read-only memory map of the file, which supports slicing and memoryview() without copying
+
     :param path_or_url:
+    :param mode: None, 'binary', 'chunks' or 'mmap'
+    :param cache: read URLs through the disk cache, see configure_url_cache(), required for 'mmap' with a URL
+    :param chunk_size: size in bytes of each chunk in the 'chunks' mode
     :return:
     """
+    if mode not in (None, 'binary', 'chunks', 'mmap'): raise ValueError(f'Unknown open() mode: {mode}')
+
     if is_url(path_or_url):
-        return urllib.request.urlopen(path_or_url)
-    else:
-        return builtins.open(path_or_url)
+        if cache and url_cache(): f = url_cache().open(path_or_url)
+        elif mode == 'mmap': raise ValueError('open() can only memory map URLs through the cache')
+        else: f = urllib.request.urlopen(path_or_url)
+    elif mode is None: return builtins.open(path_or_url)
+    else: f = builtins.open(path_or_url, 'rb')
+
+    if mode == 'chunks': return _iter_chunks(f, chunk_size)
+    elif mode == 'mmap': return _memory_map(f)
+    else: return f
+
+
+def _iter_chunks(f, chunk_size):
+    """Yield memoryviews of the file's content, read chunk by chunk into a single buffer, then close the file"""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with f:
+        while True:
+            read = f.readinto(buffer)
+            if not read: break
+            yield view[:read]
+
+
+def _memory_map(f):
+    """Return a read-only memory map of the file, then close the file"""
+    with f:
+        if os.fstat(f.fileno()).st_size == 0: return memoryview(b'')  # Empty files can't be mapped
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def url_cache():
+    """Return the disk cache used by open() for URLs, or None if disabled or it can't be created"""
+    global _url_cache, _url_cache_enabled
+    if _url_cache is None and _url_cache_enabled:
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        try: _url_cache = URLCache(os.path.join(cache_home, 'nbtools', 'urls'))
+        except OSError as e:  # Read URLs directly rather than failing
+            logging.warning(f'nbtools unable to create the URL cache, downloads won\'t be cached: {e}')
+            _url_cache_enabled = False
+    return _url_cache
+
+
+def configure_url_cache(enabled=True, directory=None, max_size=URLCache.MAX_SIZE, offline=False):
+    """
+    Configure the disk cache used by open() for URLs
+
+    :param enabled: cache downloads, if False open() reads URLs directly
+    :param directory: directory holding the cache, defaults to nbtools/urls in the user's cache directory
+    :param max_size: maximum size of the cache in bytes, the least recently used files are removed when over
+    :param offline: use cached copies without checking the server for changes
+    """
+    global _url_cache, _url_cache_enabled
+    _url_cache_enabled = enabled
+    _url_cache = None
+    if enabled:
+        _url_cache = url_cache() if directory is None else URLCache(directory)
+        if _url_cache is None: return  # The default directory is unavailable
+        _url_cache.max_size = max_size
+        _url_cache.offline = offline
+        _url_cache._evict()
 
 
 def python_safe(raw_name):
@@ -34,15 +112,97 @@ def python_safe(raw_name):
     return re.sub('[^0-9a-zA-Z]', '_', raw_name)
 
 
-def usage_tracker(event_token, description='', endpoint='https://workspace.g2nb.org/services/usage/'):
-    """We maintain a basic counter of how many times our tools are used; this helps us secure funding.
-       No identifying information is sent."""
+class UsageTracker(object):
+    """
+    Counts tool usage in process and reports it to the usage endpoint from a single background worker
+
+    Events are counted by token and description, and sent every FLUSH_INTERVAL seconds over a pooled HTTP session
+    with a timeout. Once MAX_PENDING events are waiting to be sent, further events are dropped rather than queued,
+    as are the rest of a flush once a request fails. Set NBTOOLS_USAGE_TRACKING=off in the environment, or
+    UsageTracker.enabled to False, to turn tracking off.
+    """
+    ENDPOINT = 'https://workspace.g2nb.org/services/usage/'
+    FLUSH_INTERVAL = 30     # Seconds between reports
+    MAX_PENDING = 1000      # Maximum number of events waiting to be sent
+    TIMEOUT = 5             # Seconds to wait for the endpoint to respond
+    enabled = os.environ.get('NBTOOLS_USAGE_TRACKING', 'on').lower() not in ('0', 'off', 'false', 'no')
+    _instances = {}         # endpoint -> UsageTracker
+
+    @staticmethod
+    def instance(endpoint=ENDPOINT):
+        if endpoint not in UsageTracker._instances:
+            UsageTracker._instances[endpoint] = UsageTracker(endpoint)
+        return UsageTracker._instances[endpoint]
+
+    def __init__(self, endpoint=ENDPOINT, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING, timeout=TIMEOUT):
+        self.endpoint = endpoint                # URL the event token is appended to
+        self.interval = interval                # Seconds between reports
+        self.max_pending = max_pending          # Maximum number of events waiting to be sent
+        self.timeout = timeout                  # Seconds to wait for the endpoint to respond
+        self.counts = OrderedDict()             # (token, description) -> number of events waiting to be sent
+        self.pending = 0                        # Number of events waiting to be sent
+        self.sending = 0                        # Number of events being sent
+        self.sent = 0                           # Number of events reported
+        self.dropped = 0                        # Number of events dropped
+        self.flush_requested = False            # Should the worker report without waiting for the interval?
+        self.condition = threading.Condition()  # Guards the counts and signals the worker
+        self.session = None                     # Pooled HTTP session, lazily created
+        self.worker = None                      # The reporting thread, lazily started
+
+    def track(self, token, description=''):
+        """Count an event, it is reported by the background worker"""
+        if not UsageTracker.enabled: return
+        with self.condition:
+            if self.pending >= self.max_pending:
+                self.dropped += 1
+                return
+            key = (token, description)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.pending += 1
+            self._ensure_worker()
 
-    # Call the usage tracker endpoint, don't break aything if there is any kind of error at all
-    def make_request_async():
-        try: requests.get(f'{endpoint}{event_token}/', data=description)
-        except: pass
+    def flush(self, timeout=None):
+        """Report the counted events now, return False if they weren't all sent before the timeout"""
+        with self.condition:
+            if self.pending:
+                self.flush_requested = True
+                self.condition.notify_all()
+            return self.condition.wait_for(lambda: not self.pending and not self.sending, timeout)
 
-    # Ping the usage tracker in its own thread, so as not to make the user wait
-    usage_thread = threading.Thread(target=make_request_async)
-    usage_thread.start()
+    def _ensure_worker(self):
+        """Lazily start the worker thread"""
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._run, name='nbtools-usage', daemon=True)
+            self.worker.start()
+            atexit.register(self.flush, timeout=self.timeout)  # Report what's left when the kernel shuts down
+
+    def _run(self):
+        """Report the counted events every interval, for as long as the kernel runs"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.flush_requested, timeout=self.interval)
+                self.flush_requested = False
+                counts, self.counts = self.counts, OrderedDict()
+                self.sending, self.pending = self.pending, 0
+
+            sent = 0
+            try:
+                if self.session is None: self.session = requests.Session()
+                for (token, description), count in counts.items():
+                    for _ in range(count):
+                        self.session.get(f'{self.endpoint}{token}/', data=description, timeout=self.timeout)
+                        sent += 1
+            except requests.RequestException as e:
+                logging.debug(f'nbtools unable to report usage: {e}')
+
+            with self.condition:
+                self.sent += sent
+                self.dropped += self.sending - sent  # Drop the rest of the report if the endpoint is unavailable
+                self.sending = 0
+                self.condition.notify_all()
+
+
+def usage_tracker(event_token, description='', endpoint=UsageTracker.ENDPOINT):
+    """We maintain a basic counter of how many times our tools are used; this helps us secure funding.
+       No identifying information is sent."""
+    UsageTracker.instance(endpoint).track(event_token, description)
@@ -0,0 +1,81 @@
+import weakref
+from threading import Lock
+
+
+class WidgetCache(object):
+    """
+    Map of keys to widgets, or to factories which build a widget when it is first looked up
+
+    Widgets built by a factory are held weakly, so that the cache doesn't keep unused widgets alive. The widget is
+    reused until it is closed or garbage collected, and only then is the factory called again. Widgets stored
+    directly are held strongly, as there is no way to build them again, and are returned until they are closed.
+    """
+
+    def __init__(self):
+        self.entries = {}   # key -> [factory or None, reference to the widget or None]
+        self.hits = 0       # Lookups answered with a live widget
+        self.misses = 0     # Lookups which called a factory to build the widget
+        self.lock = Lock()  # Guards the entries and counters
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def set(self, key, widget):
+        """Store a widget, or a callable which builds the widget, under the key"""
+        with self.lock:
+            if callable(widget) and not WidgetCache._is_widget(widget): self.entries[key] = [widget, None]
+            else: self.entries[key] = [None, lambda: widget]
+
+    def get(self, key):
+        """Return the live widget stored under the key, building it if necessary, return None if there is none"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            factory, reference = entry
+            widget = reference() if reference else None
+            if widget is not None and not WidgetCache._closed(widget):
+                self.hits += 1
+                return widget
+            if factory is None:  # A stored widget which has since been closed
+                del self.entries[key]
+                return None
+            self.misses += 1
+
+        # Build the widget outside the lock, in case the factory looks up other widgets
+        widget = factory()
+        with self.lock:
+            if self.entries.get(key) is entry and widget is not None: entry[1] = WidgetCache._reference(widget)
+        return widget
+
+    def pop(self, key, default=None):
+        """Remove the key, returning its live widget if any"""
+        with self.lock: entry = self.entries.pop(key, None)
+        if entry is None or entry[1] is None: return default
+        widget = entry[1]()
+        return default if widget is None else widget
+
+    def stats(self):
+        """Return the number of entries and the hit and miss counts"""
+        with self.lock: return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def _is_widget(obj):
+        """Some widgets, such as UIBuilder, are callable but are not factories"""
+        return hasattr(obj, 'comm') or hasattr(obj, 'model_id')
+
+    @staticmethod
+    def _closed(widget):
+        """Closed ipywidgets have no comm"""
+        return hasattr(widget, 'comm') and widget.comm is None
+
+    @staticmethod
+    def _reference(widget):
+        """Return a weak reference to a built widget, or a strong one if the object doesn't support weak references"""
+        try: return weakref.ref(widget)
+        except TypeError: return lambda: widget
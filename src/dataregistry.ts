@@ -172,6 +172,9 @@ export class DataRegistry implements IDataRegistry {
         const data_list = message['data'];
         const origins = message['origins'];
 
+        // Apply deltas to the existing cache
+        if (message['since'] !== undefined) return this.apply_delta(kernel_id, message);
+
         // Update the origin cache
         this.kernel_origin_cache[kernel_id] = {};
         this.register_all_origins(origins);
@@ -181,6 +184,35 @@ export class DataRegistry implements IDataRegistry {
         this.register_all(data_list);
     }
 
+    /**
+     * Apply the changes in a delta update to the cache for the specified kernel
+     *
+     * @param kernel_id
+     * @param message
+     */
+    apply_delta(kernel_id:string, message:any) {
+        // Lazily initialize the caches
+        const origin_cache = this.kernel_origin_cache[kernel_id] || (this.kernel_origin_cache[kernel_id] = {});
+        const data_cache = this.kernel_data_cache[kernel_id] || (this.kernel_data_cache[kernel_id] = {});
+
+        // Add or replace changed origins and data
+        for (const origin of message['origins']) origin_cache[origin.name] = origin;
+        for (const d of message['data']) {
+            if (!data_cache[d.origin]) data_cache[d.origin] = {};
+            data_cache[d.origin][d.uri] = [new Data(d.origin, d.uri, d.label, d.kind, d.group, d.widget, d.icon)];
+        }
+
+        // Remove deleted origins and data
+        for (const name of message['removed']['origins']) delete origin_cache[name];
+        for (const [origin, uri] of message['removed']['data']) {
+            if (!data_cache[origin]) continue;
+            delete data_cache[origin][uri];
+            if (!Object.keys(data_cache[origin]).length) delete data_cache[origin];
+        }
+
+        this.execute_callbacks();
+    }
+
     /**
      * List all data currently in the registry
      */
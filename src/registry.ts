@@ -9,11 +9,24 @@ export const IToolRegistry = new Token<IToolRegistry>("nbtools");
 export interface IToolRegistry {}
 
 export class ToolRegistry implements ToolRegistry {
-    public comm:any = null;                         // Reference to the comm used to communicate with the kernel
+    public comms:Map<any, any> = new Map();         // Notebook widget -> comm connected to its kernel
     public current:Widget|null = null;              // Reference to the currently selected notebook or other widget
     private _update_callbacks:Array<Function> = []; // Functions to call when an update happens
     kernel_tool_cache:any = {};                     // Keep a cache of kernels to registered tools
     kernel_import_cache:any = {};                   // Keep a cache of whether nbtools has been imported
+    kernel_version_cache:any = {};                  // Keep a cache of the registry version applied for each kernel
+    kernel_registry_cache:any = {};                 // Keep a cache of the registry id each version belongs to
+    kernel_stale_cache:any = {};                    // Keep a cache of whether the registry is a restored snapshot
+    private _received:Promise<any> = Promise.resolve(); // Chain of received messages, handled in order
+    private _requests:any = {};                     // Pending kernel requests, request number -> resolve callback
+    private _request_count = 0;                     // Number of kernel requests made
+
+    /**
+     * The comm connected to the kernel of the currently selected notebook
+     */
+    get comm():any {
+        return this.comms.get(this.current) || null;
+    }
 
     /**
      * Initialize the ToolRegistry and connect event handlers
@@ -63,33 +76,44 @@ export class ToolRegistry implements ToolRegistry {
         ContextManager.context().kernel_ready(this.current, () => {
             const current:any = this.current;
 
+            // Already connected, catch up on the changes made while the notebook was in the background
+            if (this.comms.has(current)) {
+                this.request_update(this.comms.get(current));
+                this.update_from_cache();
+                return;
+            }
+
             // Create a new comm that connects to the nbtools_comm target
             const connect_comm = () => {
+                // Close this notebook's previous comm so that its old kernel stops sending updates to it
+                const previous = this.comms.get(current);
+                if (previous) try { previous.close(); } catch (e) { /* The kernel may already be gone */ }
+
                 const comm = ContextManager.context().create_comm(current, 'nbtools_comm', (msg:any) => {
-                    // Handle message sent by the kernel
-                    const data = msg.content.data;
-
-                    if (data.func === 'update') {
-                        this.update_tools(data.payload);
-                        ContextManager.data_registry.update_data(data.payload);
-                    }
-                    else if (data.func === 'notification') send_notification(data.payload.message, data.payload.sender,
-                        ContextManager.context().default_logo());
-                    else console.error('ToolRegistry received unknown message: ' + data);
+                    // Handle messages sent by the kernel in order, decoding them may be asynchronous
+                    this._received = this._received
+                        .then(() => this.receive(comm, msg))
+                        .catch((e:any) => console.error('ToolRegistry unable to handle message', e));
                 });
 
-                this.comm = comm;
+                this.comms.set(current, comm);
 
                 // (window as any).comm = comm;
                 // (window as any).ToolRegistry = ToolRegistry;
 
-                // Request the current tool list
-                this.request_update(comm);
+                // Request the current tool list, background notebooks catch up when selected
+                if (this.current === current) this.request_update(comm);
             };
 
             // When the kernel restarts or is changed, reconnect the comm
             ContextManager.context().kernel_changed(current, () => connect_comm());
 
+            // Close the comm when the notebook is closed
+            if (current && current.disposed) current.disposed.connect(() => {
+                try { this.comms.get(current).close(); } catch (e) { /* The kernel may already be gone */ }
+                this.comms.delete(current);
+            });
+
             // Connect to the comm upon initial startup
             connect_comm();
 
@@ -98,6 +122,56 @@ export class ToolRegistry implements ToolRegistry {
         });
     }
 
+    /**
+     * Handle a message sent by the kernel
+     *
+     * @param comm
+     * @param msg
+     */
+    async receive(comm:any, msg:any) {
+        // Caches are keyed by the selected notebook's kernel, so ignore messages from background notebooks
+        if (comm !== this.comm) return;
+        const data = msg.content.data;
+
+        if (data.func === 'update') {
+            const payload = await ToolRegistry.decode(data.payload, msg.buffers);
+
+            // If the update can't be applied to the cached version, request everything
+            if (!this.update_tools(payload)) return this.request_update(comm, false);
+            if (!payload.unchanged) ContextManager.data_registry.update_data(payload);
+            this.acknowledge(comm, payload.version);
+        }
+        else if (data.func === 'search' || data.func === 'tool_details') {
+            const resolve = this._requests[data.payload.request];
+            delete this._requests[data.payload.request];
+            if (resolve) resolve(data.payload);
+        }
+        else if (data.func === 'notification') send_notification(data.payload.message, data.payload.sender,
+            ContextManager.context().default_logo());
+        else console.error('ToolRegistry received unknown message: ' + data);
+    }
+
+    /**
+     * Payload encodings this browser is able to decode
+     */
+    static supported_encodings():Array<string> {
+        return typeof (window as any).DecompressionStream !== 'undefined' ? ['zlib'] : [];
+    }
+
+    /**
+     * Decode the registry sections of an update payload sent as compressed JSON in a binary buffer
+     *
+     * @param payload
+     * @param buffers
+     */
+    static async decode(payload:any, buffers:Array<any>|undefined):Promise<any> {
+        if (payload.encoding !== 'zlib' || !buffers || !buffers.length) return payload;
+
+        const stream = new Blob([buffers[0]]).stream().pipeThrough(new (window as any).DecompressionStream('deflate'));
+        const sections = JSON.parse(await new Response(stream).text());
+        return {...payload, ...sections};
+    }
+
     /**
      * Get tools from the cache and make registered callbacks
      */
@@ -117,11 +191,30 @@ export class ToolRegistry implements ToolRegistry {
 
     /**
      * Message the kernel, requesting an update to the tools cache
+     * If use_cache is true, send the cached registry version so the kernel only needs to send what has changed
+     *
+     * @param comm
+     * @param use_cache
+     */
+    request_update(comm:any, use_cache=true) {
+        const payload:any = {'encodings': ToolRegistry.supported_encodings(), 'stubs': true};
+        const kernel_id = this.current_kernel_id();
+        if (use_cache && kernel_id && this.kernel_registry_cache[kernel_id]) {
+            payload['registry'] = this.kernel_registry_cache[kernel_id];
+            payload['version'] = this.kernel_version_cache[kernel_id];
+        }
+        comm.send({'func': 'request_update', 'payload': payload});
+    }
+
+    /**
+     * Tell the kernel which registry version has been applied, so that future updates only include changes
      *
      * @param comm
+     * @param version
      */
-    request_update(comm:any) {
-        comm.send({'func': 'request_update'});
+    acknowledge(comm:any, version:number) {
+        if (version === undefined) return;  // Older kernels don't version updates
+        comm.send({'func': 'ack', 'payload': {'version': version}});
     }
 
     /**
@@ -135,6 +228,53 @@ export class ToolRegistry implements ToolRegistry {
         comm.send({'func': command, 'payload': payload});
     }
 
+    /**
+     * Search the tools registered in the kernel, resolving to a list of [origin, id] keys, best matches first
+     * Resolves to null if the kernel is unable to search
+     *
+     * @param query
+     */
+    search(query:string):Promise<Array<Array<string>>|null> {
+        const reply = this.send_request('search', {'query': query});
+        return reply ? reply.then((payload:any) => payload.results) : Promise.resolve(null);
+    }
+
+    /**
+     * Load the full description of a tool listed as a stub, updating the cached tool
+     * Resolves to the tool, which is returned as is if its details are already loaded
+     *
+     * @param tool
+     */
+    tool_details(tool:any):Promise<any> {
+        if (tool.description !== undefined) return Promise.resolve(tool);
+        const reply = this.send_request('tool_details', {'tools': [[tool.origin, tool.id]]});
+        if (!reply) return Promise.resolve(tool);
+
+        return reply.then((payload:any) => {
+            if (payload.tools.length) Object.assign(tool, payload.tools[0]);
+            return tool;
+        });
+    }
+
+    /**
+     * Send a request to the kernel, returning a promise that resolves to the payload of the reply
+     * Returns null if the kernel is unable to answer requests
+     *
+     * @param func
+     * @param payload
+     */
+    send_request(func:string, payload:any):Promise<any>|null {
+        // Kernels that version their registries are able to answer requests
+        const kernel_id = this.current_kernel_id();
+        if (!this.comm || !kernel_id || !this.kernel_registry_cache[kernel_id]) return null;
+
+        const request = ++this._request_count;
+        return new Promise((resolve) => {
+            this._requests[request] = resolve;
+            this.comm.send({'func': func, 'payload': {...payload, 'request': request}});
+        });
+    }
+
     /**
      * Register an update callback with the ToolRegistry
      *
@@ -154,25 +294,67 @@ export class ToolRegistry implements ToolRegistry {
 
     /**
      * Update the tools cache for the current kernel
+     * Return false if the message is a delta that can't be applied to the cached version
      *
      * @param message
      */
-    update_tools(message:any) {
+    update_tools(message:any):boolean {
         const kernel_id = this.current_kernel_id();
-        if (!kernel_id) return; // Do nothing if no kernel
+        if (!kernel_id) return true; // Do nothing if no kernel
 
         // Parse the message
         const tool_list = message['tools'];
         const needs_import = !!message['import'];
-
-        // Update the cache
-        this.kernel_tool_cache[kernel_id] = tool_list;
+        const cached_version = this.kernel_registry_cache[kernel_id] === message['registry'] ?
+            this.kernel_version_cache[kernel_id] : undefined;
+
+        // Update the cache, either confirming it, applying the delta or replacing everything
+        if (message['unchanged']) {
+            if (cached_version !== message['version']) return false;
+        }
+        else if (message['since'] !== undefined) {
+            if (cached_version === undefined || cached_version < message['since']) return false;
+            if (message['version'] <= cached_version) return true;  // Already applied
+            const cache = this.kernel_tool_cache[kernel_id];
+            tool_list.forEach((tool:any) => cache[ToolRegistry.tool_key(tool.origin, tool.id)] = tool);
+            message['removed']['tools'].forEach((key:Array<string>) => delete cache[ToolRegistry.tool_key(key[0], key[1])]);
+        }
+        else {
+            const cache:any = {};
+            tool_list.forEach((tool:any) => cache[ToolRegistry.tool_key(tool.origin, tool.id)] = tool);
+            this.kernel_tool_cache[kernel_id] = cache;
+        }
+        this.kernel_version_cache[kernel_id] = message['version'];
+        this.kernel_registry_cache[kernel_id] = message['registry'];
         this.kernel_import_cache[kernel_id] = needs_import;
+        this.kernel_stale_cache[kernel_id] = !!message['stale'];
 
         // Make registered callbacks when tools are updated
+        const tools = this.list();
         this._update_callbacks.forEach((callback) => {
-            callback(tool_list);
+            callback(tools);
         });
+        return true;
+    }
+
+    /**
+     * Key used to identify a tool in the cache
+     *
+     * @param origin
+     * @param id
+     */
+    static tool_key(origin:string, id:string|number):string {
+        return `${origin}|${id}`;
+    }
+
+    /**
+     * Query whether the listed tools were restored from a snapshot and are not yet confirmed by the kernel
+     */
+    is_stale():Boolean {
+        const kernel_id = this.current_kernel_id();
+        if (!kernel_id) return false; // Assume false if no kernel
+
+        return !!this.kernel_stale_cache[kernel_id];
     }
 
     /**
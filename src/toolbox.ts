@@ -2,6 +2,7 @@ import { PanelLayout, Widget } from '@lumino/widgets';
 import { toggle } from "./utils";
 import { ContextManager } from "./context";
 import { NotebookActions, NotebookPanel } from "@jupyterlab/notebook";
+import { ToolRegistry } from "./registry";
 
 export class ToolBrowser extends Widget {
     public search:SearchBox|null = null;
@@ -11,7 +12,7 @@ export class ToolBrowser extends Widget {
         super();
         this.addClass('nbtools-browser');
         this.layout = new PanelLayout();
-        this.search = new SearchBox('#nbtools-browser > .nbtools-toolbox');
+        this.search = new SearchBox('#nbtools-browser > .nbtools-toolbox', true);
         this.toolbox = new Toolbox(this.search);
 
         (this.layout as PanelLayout).addWidget(this.search);
@@ -20,8 +21,10 @@ export class ToolBrowser extends Widget {
 }
 
 export class Toolbox extends Widget {
+    static RENDER_CHUNK = 200;  // Number of tools to render before yielding to the browser
     last_update = 0;
     update_waiting = false;
+    render_count = 0;           // Incremented each time the toolbox is filled, so stale renders can stop
     search:SearchBox;
 
     constructor(associated_search:SearchBox) {
@@ -91,6 +94,9 @@ export class Toolbox extends Widget {
         // First empty the toolbox
         this.empty_toolbox();
 
+        // Mark tools restored from a kernel snapshot until their registration is confirmed
+        this.node.classList.toggle('nbtools-stale', ContextManager.tool_registry.is_stale());
+
         // Get the list of tools
         const tools = ContextManager.tool_registry.list();
 
@@ -103,16 +109,22 @@ export class Toolbox extends Widget {
             return (a_name < b_name) ? -1 : (a_name > b_name) ? 1 : 0;
         });
 
-        // Add each origin
+        // Add each origin, then render its tools in chunks so that large origins don't block the browser
+        const queue:Array<any> = [];
         origins.forEach((origin) => {
             const origin_box = this.add_origin(origin);
-            organized_tools[origin].forEach((tool:any) => {
-                this.add_tool(origin_box, tool);
-            })
+            organized_tools[origin].forEach((tool:any) => queue.push([origin_box, tool]));
         });
-
-        // Apply search filter after refresh
-        this.search.filter(this.search.node.querySelector('input.nbtools-search') as HTMLInputElement);
+        const render = ++this.render_count;
+        const render_chunk = (start:number) => {
+            if (render !== this.render_count) return;  // The toolbox has since been refilled
+            queue.slice(start, start + Toolbox.RENDER_CHUNK).forEach(([origin_box, tool]) => this.add_tool(origin_box, tool));
+
+            // Apply search filter after refresh
+            if (start + Toolbox.RENDER_CHUNK < queue.length) requestAnimationFrame(() => render_chunk(start + Toolbox.RENDER_CHUNK));
+            else this.search.filter(this.search.node.querySelector('input.nbtools-search') as HTMLInputElement);
+        };
+        render_chunk(0);
     }
 
     organize_tools(tool_list:Array<any>):any {
@@ -164,13 +176,22 @@ export class Toolbox extends Widget {
         const list = origin.querySelector('ul');
         const tool_wrapper = document.createElement('li');
         tool_wrapper.classList.add('nbtools-tool');
+        tool_wrapper.dataset.key = ToolRegistry.tool_key(tool.origin, tool.id);
         tool_wrapper.setAttribute('title', 'Click to add to notebook');
         tool_wrapper.innerHTML = `
             <div class="nbtools-add">+</div>
             <div class="nbtools-header">${tool.name}</div>
-            <div class="nbtools-description">${tool.description}</div>`;
+            <div class="nbtools-description">${tool.description !== undefined ? tool.description : ''}</div>`;
         if (list) list.append(tool_wrapper);
 
+        // Tools listed as stubs load their description when hovered
+        if (tool.description === undefined) tool_wrapper.addEventListener("mouseenter", () => {
+            ContextManager.tool_registry.tool_details(tool).then((details:any) => {
+                const description = tool_wrapper.querySelector('.nbtools-description') as HTMLElement;
+                description.innerHTML = details.description || '';
+            });
+        }, { once: true });
+
         // Add the click event
         tool_wrapper.addEventListener("click", () => {
             Toolbox.add_tool_cell(tool);
@@ -199,11 +220,13 @@ export class Toolbox extends Widget {
 
 export class SearchBox extends Widget {
     panel_query:string;
+    kernel_search:boolean;
     value:string;
 
-    constructor(panel_query:string) {
+    constructor(panel_query:string, kernel_search=false) {
         super();
         this.panel_query = panel_query;
+        this.kernel_search = kernel_search;  // Search the kernel's tool index rather than the rendered text
         this.value = '';
         this.node.innerHTML = `
             <div class="nbtools-wrapper">
@@ -230,6 +253,22 @@ export class SearchBox extends Widget {
         const panel = document.querySelector(this.panel_query) as HTMLElement|null;
         if (!panel) return; // Do nothing if the panel is null
 
+        // Search the kernel's index, falling back to filtering the rendered tools if the kernel can't search
+        if (!this.value || !this.kernel_search) return this.filter_text(panel);
+        const query = search_box.value;
+        ContextManager.tool_registry.search(query).then((results:Array<Array<string>>|null) => {
+            if (query !== search_box.value) return;  // A newer search has replaced this one
+            if (results === null) return this.filter_text(panel);
+
+            // Show any tool in the results and hide anything else
+            const matches = new Set(results.map((key) => ToolRegistry.tool_key(key[0], key[1])));
+            panel.querySelectorAll('li.nbtools-tool').forEach((tool:any) => {
+                tool.style.display = matches.has(tool.dataset.key) ? 'block' : 'none';
+            });
+        });
+    }
+
+    filter_text(panel:HTMLElement) {
         // Show any tool that matches and hide anything else
         panel.querySelectorAll('li.nbtools-tool').forEach((tool:any) => {
             if (tool.textContent.toLowerCase().replace(/[^a-z0-9]/g, '').includes(this.value)) tool.style.display = 'block';